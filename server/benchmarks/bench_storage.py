@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chord.storage import Data, RAMStorage
+
+# Record with a __dict__, the layout Data had before it was slotted
+class DictData:
+    def __init__(self, value: str, version: int, active: bool = True, position: int = None) -> None:
+        self.value = value
+        self.version = version
+        self.active = active
+        self.position = position
+
+    def digest(self) -> int:
+        return zlib.crc32(self.value.encode('utf-8'))
+
+# Bytes allocated per key by a RAMStorage filled with keys and values like the ones of the services
+def bytes_per_key(record, keys: int, value_size: int) -> float:
+    items = [(f'User/user{i}/following', 'x' * value_size) for i in range(keys)]
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    storage = RAMStorage()
+    for version, (key, value) in enumerate(items):
+        storage.set(key, record(value, version))
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (after - before) / keys
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory used by each key of the RAM storage')
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--value-size', type=int, default=16)
+    args = parser.parse_args()
+
+    print(f'{args.keys} keys, {args.value_size} bytes values')
+    for name, record in (('slotted Data', Data), ('dict Data', DictData)):
+        start = time.perf_counter()
+        size = bytes_per_key(record, args.keys, args.value_size)
+        print(f'{name:>12}: {size:8.1f} bytes/key ({time.perf_counter() - start:.2f}s)')
+
+if __name__ == '__main__':
+    main()
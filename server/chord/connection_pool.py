@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import socket
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+from chord.protocol import read_message, write_message
+from config import CHANNEL_MAX_IN_FLIGHT, CONNECTION_IDLE_TIMEOUT, CONNECTION_POOL_SIZE, CONNECTION_TIMEOUT
+
+Peer = Tuple[str, int]
+RTT_WEIGHT = 0.2 # Weight of the last request in the average round trip
+
+# Persistent stream to another node carrying many requests at once.
+# Responses are matched to their request by id, in whatever order they arrive.
+class Channel:
+    def __init__(self, peer: Peer, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.peer = peer
+        self.reader = reader
+        self.writer = writer
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.uses = 0
+        self.closed = False
+        self.last_used = time.monotonic()
+        self.reader_task = asyncio.create_task(self._read_responses())
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.pending)
+
+    def is_healthy(self) -> bool:
+        return not self.closed and not self.writer.is_closing()
+
+    async def request(self, op: int, request_id: int, fields: List[Any], timeout: float) -> List[Any]:
+        if not self.is_healthy():
+            raise ConnectionError(f'Channel to {self.peer[0]} is closed')
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.uses += 1
+        try:
+            # The whole frame goes in a single write, so concurrent requests never interleave
+            write_message(self.writer, op, request_id, fields)
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+            self.last_used = time.monotonic()
+
+    async def _read_responses(self):
+        error: Exception = ConnectionError(f'Channel to {self.peer[0]} closed by peer')
+        try:
+            while True:
+                message = await read_message(self.reader)
+                if message is None:
+                    break
+
+                _, request_id, fields = message
+                future = self.pending.get(request_id)
+                if future and not future.done():
+                    future.set_result(fields)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f'Error reading from {self.peer[0]}: {e!r}')
+            error = ConnectionError(f'Channel to {self.peer[0]} failed: {e!r}')
+        finally:
+            self.close(error)
+
+    def close(self, error: Exception = None):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+
+        error = error or ConnectionError(f'Channel to {self.peer[0]} closed')
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+
+        if self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()
+
+# Keeps up to max_per_peer channels for every (ip, port) and sends each request through the least loaded one.
+# A new channel is only opened when every existing one has max_in_flight requests waiting.
+# Only used from the transport event loop.
+class ConnectionPool:
+    def __init__(self, max_per_peer: int = CONNECTION_POOL_SIZE, max_in_flight: int = CHANNEL_MAX_IN_FLIGHT, idle_timeout: int = CONNECTION_IDLE_TIMEOUT, timeout: int = CONNECTION_TIMEOUT) -> None:
+        self.max_per_peer = max_per_peer
+        self.max_in_flight = max_in_flight
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self.channels: Dict[Peer, List[Channel]] = defaultdict(list)
+        self.connecting: Dict[Peer, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.last_eviction = time.monotonic()
+        self.rtts: Dict[Peer, float] = {} # Moving average of the seconds a request to each peer takes
+
+    async def get(self, ip: str, port: int) -> Channel:
+        peer = (ip, int(port))
+        self._evict_idle()
+
+        channel = self._least_loaded(peer)
+        if channel and (channel.in_flight < self.max_in_flight or len(self.channels[peer]) >= self.max_per_peer):
+            return channel
+
+        # Only one coroutine opens a channel to a peer at a time, the others reuse it
+        async with self.connecting[peer]:
+            channel = self._least_loaded(peer)
+            if channel and (channel.in_flight < self.max_in_flight or len(self.channels[peer]) >= self.max_per_peer):
+                return channel
+
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*peer), self.timeout)
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            channel = Channel(peer, reader, writer)
+            self.channels[peer].append(channel)
+            return channel
+
+    # Record how long a request to a peer took
+    def observe(self, peer: Peer, seconds: float):
+        rtt = self.rtts.get(peer)
+        self.rtts[peer] = seconds if rtt is None else rtt + RTT_WEIGHT * (seconds - rtt)
+
+    # Average round trip to a peer, 0 before the first request so every peer gets measured
+    def rtt(self, ip: str, port: int) -> float:
+        return self.rtts.get((ip, int(port)), 0.0)
+
+    # Requests waiting for an answer of a peer
+    def in_flight(self, ip: str, port: int) -> int:
+        return sum(channel.in_flight for channel in self.channels.get((ip, int(port)), []))
+
+    def _least_loaded(self, peer: Peer) -> Channel:
+        channels = [channel for channel in self.channels[peer] if channel.is_healthy()]
+        self.channels[peer] = channels
+        return min(channels, key=lambda channel: channel.in_flight, default=None)
+
+    # Close channels without requests nobody used for idle_timeout seconds, checked at most twice per timeout
+    def _evict_idle(self):
+        now = time.monotonic()
+        if now - self.last_eviction < self.idle_timeout / 2:
+            return
+        self.last_eviction = now
+
+        for peer in list(self.channels.keys()):
+            alive: List[Channel] = []
+            for channel in self.channels[peer]:
+                if channel.in_flight == 0 and now - channel.last_used > self.idle_timeout:
+                    channel.close()
+                elif channel.is_healthy():
+                    alive.append(channel)
+
+            if alive:
+                self.channels[peer] = alive
+            else:
+                del self.channels[peer]
+                self.connecting.pop(peer, None)
@@ -15,11 +15,22 @@ ELECTION = 13
 GET_SUCCESSOR_AND_NOTIFY = 14
 SET_PARTITION = 15
 RESOLVE_DATA = 16
+RETRIEVE_MANY = 17
+STORE_MANY = 18
+DELETE_MANY = 19
+EXCHANGE_MEMBERS = 20
+PURGE_KEYS = 21
+MERKLE_HASHES = 22
+MERKLE_KEYS = 23
+GET_SUCCESSORS = 24
 
 # Booleans
 FALSE = 0
 TRUE = 1
 
+# Reply of a node asked for a key outside its range
+NOT_RESPONSIBLE = 2
+
 # Messages
 ALIVE = 'Im alive'
 ARE_YOU = 'Are you a chord?'
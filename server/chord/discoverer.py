@@ -1,6 +1,5 @@
 import logging
 import socket
-import time
 
 from chord.node_reference import ChordNodeReference
 from chord.constants import ARE_YOU, EMPTY, YES_IM
@@ -25,8 +24,8 @@ class Discoverer:
                 self.node.successors.clear()
                 self.node.successors.set_index(0, node.find_successor(self.node.id))
                 succ: ChordNodeReference = self.node.successors.get_index(0)
-                with self.finger.finger_lock:
-                    self.finger.finger[0] = succ
+                self.finger.set_finger(0, succ)
+                self.finger.request_rebuild()
                 with self.elector.leader_lock:
                     self.elector.leader = leader
                 succ.notify(self.node.ref)
@@ -141,26 +140,24 @@ class Discoverer:
         self.create_ring()
 
     def discover_and_join(self):
-        while not self.node.shutdown_event.is_set():
-            try:
-                with self.elector.leader_lock:
-                    leader_id = self.elector.leader.id
-                with self.node.succ_lock: 
-                    succ: ChordNodeReference = self.node.successors.get_index(0)
-                with self.node.pred_lock: 
-                    pred: ChordNodeReference = self.node.predecessors.get_index(0)
-                alone = succ.id == pred.id and succ.id == self.node.id
-
-                if leader_id == self.node.id or alone:
-                    node_ip, leader_ip, error = self.send_announcement()
-                    if error or node_ip == EMPTY:
-                        if error:
-                            logging.error(f'Error in broadcast: {error}')
-                    else:
-                        leader = ChordNodeReference(leader_ip)
-                        if leader.id > self.node.id:
-                            if not self.join(node_ip, leader_ip):
-                                logging.error(f'Joining to {node_ip}')
-            except Exception as e:
-                logging.error(f'Error in discover and join thread: {e}')
-            time.sleep(60)
\ No newline at end of file
+        try:
+            with self.elector.leader_lock:
+                leader_id = self.elector.leader.id
+            with self.node.succ_lock: 
+                succ: ChordNodeReference = self.node.successors.get_index(0)
+            with self.node.pred_lock: 
+                pred: ChordNodeReference = self.node.predecessors.get_index(0)
+            alone = succ.id == pred.id and succ.id == self.node.id
+
+            if leader_id == self.node.id or alone:
+                node_ip, leader_ip, error = self.send_announcement()
+                if error or node_ip == EMPTY:
+                    if error:
+                        logging.error(f'Error in broadcast: {error}')
+                else:
+                    leader = ChordNodeReference(leader_ip)
+                    if leader.id > self.node.id:
+                        if not self.join(node_ip, leader_ip):
+                            logging.error(f'Joining to {node_ip}')
+        except Exception as e:
+            logging.error(f'Error in discover and join task: {e}')
\ No newline at end of file
@@ -1,9 +1,7 @@
 import logging
 import threading
-import time
 from chord.timer import Timer
 from chord.node_reference import ChordNodeReference
-from config import SEPARATOR
 
 class Elector:
     def __init__(self, node, timer: Timer) -> None:
@@ -23,35 +21,30 @@ class Elector:
             return self.timer.time_counter
 
     def check_leader(self):
-        while not self.node.shutdown_event.is_set():
-            with self.leader_lock:
-                if self.leader and self.leader.id != self.node.id:
-                    logging.info(f"Check leader: {self.leader.id}")
+        with self.leader_lock:
+            if self.leader and self.leader.id != self.node.id:
+                logging.info(f"Check leader: {self.leader.id}")
 
+                with self.timer.time_lock:
+                    current_time = self.timer.time_counter
+
+                try:
+                    time_response = self.leader.ping_leader(self.node.id, current_time)
                     with self.timer.time_lock:
-                        current_time = self.timer.time_counter
-
-                    try:
-                        time_response = self.leader.ping_leader(self.node.id, current_time)
-                        with self.timer.time_lock:
-                            self.timer.time_counter = time_response
-                            self.timer.node_timers[self.node.id] = time_response
-                    except Exception as e:
-                        logging.error(f"Leader {self.leader.id} failed: {e}")
-                        self.request_election()
-            time.sleep(10)
-
-    def election_thread(self):
-        logging.info("Election requested thread started")
-        while not self.node.shutdown_event.is_set():
-            try:
-                with self.leader_lock:
-                    leader_id = self.leader.id
-                if leader_id == self.node.id:
+                        self.timer.time_counter = time_response
+                        self.timer.node_timers[self.node.id] = time_response
+                except Exception as e:
+                    logging.error(f"Leader {self.leader.id} failed: {e}")
                     self.request_election()
-            except Exception as e:
-                logging.error(f'Error in election thread: {e}')
-            time.sleep(60)
+
+    def election_task(self):
+        try:
+            with self.leader_lock:
+                leader_id = self.leader.id
+            if leader_id == self.node.id:
+                self.request_election()
+        except Exception as e:
+            logging.error(f'Error in election task: {e}')
 
     def request_election(self):
         with self.node.succ_lock:
@@ -79,7 +72,7 @@ class Elector:
                 self.leader = self.node.ref
             logging.error(f"Election failed: {e}")
 
-    def election(self, first_id, leader_ip, leader_port):
+    def election(self, first_id, leader_ip, leader_port) -> ChordNodeReference:
         leader = ChordNodeReference(leader_ip, leader_port)
 
         if self.node.id > leader.id:
@@ -92,7 +85,7 @@ class Elector:
             with self.leader_lock:
                 self.leader = leader
 
-            return f'{leader.ip}{SEPARATOR}{leader.port}'
+            return leader
 
         ok = succ.ping()
         if not ok:
@@ -108,4 +101,4 @@ class Elector:
         with self.leader_lock:
             self.leader = leader
 
-        return f'{leader.ip}{SEPARATOR}{leader.port}'
\ No newline at end of file
+        return leader
\ No newline at end of file
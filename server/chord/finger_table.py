@@ -1,8 +1,11 @@
+import bisect
 import logging
 import threading
-import time
+from typing import List, Tuple
 from chord.node_reference import ChordNodeReference
+from chord.transport import run_all
 from chord.utils import inbetween
+from config import FIX_FINGERS_BATCH
 
 
 class FingerTable:
@@ -12,58 +15,131 @@ class FingerTable:
         self.finger = [self.node.ref] * self.m  # Finger table
         self.next = 0  # Finger table index to fix next
         self.finger_lock = threading.RLock() 
+        # Distinct fingers sorted by their distance from this node, replaced as a whole on every update
+        self.index: Tuple[List[int], List[ChordNodeReference]] = ([], [])
+        self.rebuild_event = threading.Event() # Set when the whole table must be rebuilt
+        self.rebuild_event.set()
 
     # Method to find the successor of a given id
     def find_succ(self, id: int) -> 'ChordNodeReference':
         logging.info(f'Find successor for {id}')
-        node = self.find_pred(id)  # Find predecessor of id
-        
-        with self.node.succ_lock:
-            if self.node.id == node.id:
-                return self.node.successors.get_index(0)
-            
-        return node.succ  # Return successor of that node
+        _, succ = self.find_range(id)
+        return succ
     
     # Method to find the predecessor of a given id
     def find_pred(self, id: int) -> 'ChordNodeReference':
-        node = self.node
-        first_time = True
-        succ: ChordNodeReference = node.successors.get_index(0)
-        while not inbetween(id, node.id, succ.id):
-            if first_time:
-                first_time = False
-                node = node.finger.closest_preceding_finger(id)
-            else:
-                node = node.closest_preceding_finger(id)
-        return node.ref if first_time else node
+        pred, _ = self.find_range(id)
+        return pred
+
+    # Method to find the consecutive nodes (pred, succ) such that id is in (pred.id, succ.id].
+    # succ is responsible for every key of that range. In one hop mode a fresh membership view
+    # answers locally, otherwise the fingers are followed.
+    def find_range(self, id: int, one_hop: bool = True) -> Tuple[ChordNodeReference, ChordNodeReference]:
+        if one_hop and self.node.membership.is_fresh():
+            found = self.node.membership.find_range(id)
+            if found:
+                return found
+
+        succ: ChordNodeReference = self.node.successors.get_index(0)
+        if inbetween(id, self.node.id, succ.id):
+            return self.node.ref, succ
+
+        node = self.closest_preceding_finger(id)
+        if node.id == self.node.id:
+            node = succ
+
+        while node.id != self.node.id:
+            node_succ = node.succ
+            if inbetween(id, node.id, node_succ.id):
+                return node, node_succ
+
+            # Walk through successors while the fingers of node are not built yet
+            next_node = node.closest_preceding_finger(id)
+            node = node_succ if next_node.id == node.id else next_node
+        return self.node.ref, succ
     
-    # Method to find the closest preceding finger of a given id
+    # Method to find the closest preceding finger of a given id, the farthest finger in (node.id, id].
+    # Bisects the compacted index, no lock is needed since it is never modified in place.
     def closest_preceding_finger(self, id: int) -> ChordNodeReference:
-        for i in range(self.m - 1, -1, -1):
-            with self.finger_lock:
-                if self.finger[i] and inbetween(self.finger[i].id, self.node.id, id):
-                    return self.finger[i]
-        return self.node.ref
+        distances, nodes = self.index
+        position = bisect.bisect_right(distances, self.distance(id)) - 1
+        return nodes[position] if position >= 0 else self.node.ref
+
+    # Distance walked clockwise from this node to id, a full turn for the node itself
+    def distance(self, id: int) -> int:
+        return (id - self.node.id) % 2 ** self.m or 2 ** self.m
+
+    # Method to set a single finger
+    def set_finger(self, i: int, node: ChordNodeReference):
+        with self.finger_lock:
+            self.finger[i] = node
+            self.compact()
+
+    # Publish the distinct fingers of the table, must be called holding finger_lock after every change
+    def compact(self):
+        nodes = {finger.id: finger for finger in self.finger if finger.id != self.node.id}
+        distances = sorted(self.distance(id) for id in nodes)
+        self.index = (distances, [nodes[(self.node.id + distance) % 2 ** self.m] for distance in distances])
     
-    # Fix fingers method to periodically update the finger table
+    # Ask the fix fingers task to rebuild the whole table, after a join or a membership change
+    def request_rebuild(self):
+        self.rebuild_event.set()
+
+    # Method to rebuild every finger at once. Consecutive starts usually share their successor,
+    # so only one lookup is made for each distinct node and the rest of its interval is copied.
+    def rebuild(self):
+        succ: ChordNodeReference = self.node.successors.get_index(0)
+        fingers = []
+        found = None
+        lookups = 0
+        for i in range(self.m):
+            start = (self.node.id + 2 ** i) % 2 ** self.m
+            if found is None or not inbetween(start, self.node.id, found.id):
+                if succ.id == self.node.id or inbetween(start, self.node.id, succ.id):
+                    found = succ
+                else:
+                    _, found = self.find_range(start)
+                    lookups += 1
+            fingers.append(found)
+
+        with self.finger_lock:
+            self.finger = fingers
+            self.next = 0
+            self.compact()
+        logging.info(f'Finger table rebuilt with {lookups} lookups, {len(set(finger.id for finger in fingers))} distinct fingers')
+
+    # Fix fingers method to periodically update the finger table.
+    # Rebuilds the whole table when requested, otherwise checks the finger intervals for changes.
     def fix_fingers(self):
-        logging.info('Fix fingers thread started')
-        while not self.node.shutdown_event.is_set():
-            try:
-                self.next += 1
-                if self.next >= self.m:
-                    self.next = 0
-
-                succ = self.find_succ((self.node.id + 2 ** self.next) % 2 ** self.m)
-                logging.info(f'Correspondent finger found at {succ.id}')
-                with self.finger_lock:
-                    if succ.id == self.node:
-                        for i in range(self.next, self.m):
-                            self.finger[i] = None
-                        self.next = 0
-                        continue
-
-                self.finger[self.next] = succ
-            except Exception as e:
-                logging.error(f"Error in fix fingers thread: {e}")
-            time.sleep(10)
\ No newline at end of file
+        try:
+            if self.rebuild_event.is_set():
+                self.rebuild_event.clear()
+                self.rebuild()
+            else:
+                self.fix_batch()
+        except Exception as e:
+            logging.error(f"Error in fix fingers task: {e}")
+
+    # Method to check up to FIX_FINGERS_BATCH finger intervals at once, pipelined through the successor.
+    # A node joining or leaving inside an interval changes the successor of its first start, so checking
+    # the first start of every distinct finger is enough to notice it and rebuild the table.
+    def fix_batch(self):
+        with self.finger_lock:
+            fingers = list(self.finger)
+        heads = [i for i in range(self.m) if i == 0 or fingers[i].id != fingers[i - 1].id]
+        indexes = [heads[(self.next + i) % len(heads)] for i in range(min(FIX_FINGERS_BATCH, len(heads)))]
+        self.next = (self.next + len(indexes)) % len(heads)
+
+        succ: ChordNodeReference = self.node.successors.get_index(0)
+        starts = [(self.node.id + 2 ** i) % 2 ** self.m for i in indexes]
+        remote = [start for start in starts if succ.id != self.node.id and not inbetween(start, self.node.id, succ.id)]
+
+        results = run_all([succ.find_successor_async(start) for start in remote])
+        found = {start: node for start, node in zip(remote, results) if isinstance(node, ChordNodeReference)}
+
+        moved = [i for i, start in zip(indexes, starts) if found.get(start, succ if start not in remote else fingers[i]).id != fingers[i].id]
+        logging.info(f'Finger intervals {indexes} checked')
+
+        if moved:
+            logging.info(f'Fingers {moved} moved, rebuilding the finger table')
+            self.request_rebuild()
@@ -0,0 +1,123 @@
+import bisect
+import logging
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from chord.node_reference import ChordNodeReference
+from chord.transport import run_all
+from chord.utils import getShaRepr
+from config import MEMBERSHIP_TTL, ONE_HOP_ROUTING
+
+# Full view of the ring for one hop routing, kept up to date by gossip during stabilize.
+# Every node bumps its own heartbeat each round, members whose heartbeat stops growing for
+# MEMBERSHIP_TTL seconds are dropped. Lookups bisect an immutable sorted snapshot without locks.
+class Membership:
+    def __init__(self, node, enabled: bool = ONE_HOP_ROUTING, ttl: int = MEMBERSHIP_TTL) -> None:
+        self.node = node
+        self.enabled = enabled
+        self.ttl = ttl
+
+        # Heartbeats start at the wall clock so a restarted node is never taken for its old self
+        self.members: Dict[str, Tuple[int, float]] = {node.ip: (int(time.time()), time.monotonic())} # ip -> (heartbeat, last time it grew)
+        self.removed: Dict[str, Tuple[int, float]] = {} # ip -> (heartbeat it had when dropped, when)
+        self.members_lock = threading.Lock()
+
+        self.view: Tuple[List[int], List[ChordNodeReference]] = ([node.id], [node.ref]) # Sorted ids and their references
+        self.refreshed = 0.0 # Last time the view was checked against the ring
+
+    # The view may answer lookups only while gossip keeps it in agreement with our successor
+    def is_fresh(self) -> bool:
+        return self.enabled and len(self.view[0]) > 1 and time.monotonic() - self.refreshed < self.ttl
+
+    def mark_stale(self):
+        self.refreshed = 0.0
+
+    # Consecutive members (pred, succ) with id in (pred.id, succ.id], None if the view can not tell
+    def find_range(self, id: int) -> Optional[Tuple[ChordNodeReference, ChordNodeReference]]:
+        ids, refs = self.view
+        if len(ids) < 2:
+            return None
+        index = bisect.bisect_left(ids, id) % len(ids)
+        return refs[index - 1], refs[index]
+
+    # Heartbeats of every live member as sent over the wire
+    def table(self) -> Dict[str, int]:
+        with self.members_lock:
+            return {ip: heartbeat for ip, (heartbeat, _) in self.members.items()}
+
+    # Keep the newest heartbeat of every member, returns True if the view changed
+    def merge(self, table: Dict[str, int]) -> bool:
+        now = time.monotonic()
+        changed = False
+        with self.members_lock:
+            for ip, heartbeat in table.items():
+                if ip == self.node.ip or (ip in self.removed and heartbeat <= self.removed[ip][0]):
+                    continue
+                known = self.members.get(ip)
+                if known is None:
+                    changed = True
+                if known is None or heartbeat > known[0]:
+                    self.members[ip] = (heartbeat, now)
+                    self.removed.pop(ip, None)
+            if changed:
+                self._rebuild()
+        return changed
+
+    # Forget a member found dead, older gossip about it is ignored
+    def remove(self, id: int):
+        with self.members_lock:
+            for ip, (heartbeat, _) in list(self.members.items()):
+                if ip != self.node.ip and getShaRepr(ip) == id:
+                    del self.members[ip]
+                    self.removed[ip] = (heartbeat, time.monotonic())
+                    self._rebuild()
+
+    # One gossip round: bump our heartbeat, expire silent members and exchange the view
+    # with the successor and a random member at once. Returns True if members joined or left.
+    def gossip(self, succ: ChordNodeReference) -> bool:
+        now = time.monotonic()
+        with self.members_lock:
+            heartbeat, _ = self.members[self.node.ip]
+            self.members[self.node.ip] = (heartbeat + 1, now)
+
+            expired = [ip for ip, (_, seen) in self.members.items() if ip != self.node.ip and now - seen > self.ttl]
+            for ip in expired:
+                self.removed[ip] = (self.members.pop(ip)[0], now)
+            changed = bool(expired)
+            if expired:
+                logging.info(f'Members {expired} expired')
+                self._rebuild()
+
+            # After two ttl every node has dropped the old heartbeats too
+            for ip in [ip for ip, (_, when) in self.removed.items() if now - when > 2 * self.ttl]:
+                del self.removed[ip]
+
+        peers = {succ.id: succ} if succ.id != self.node.id else {}
+        others = [ref for ref in self.view[1] if ref.id != self.node.id and ref.id != succ.id]
+        if others:
+            peer = random.choice(others)
+            peers[peer.id] = peer
+
+        table = self.table()
+        results = run_all([peer.exchange_members_async(table) for peer in peers.values()])
+        for result in results:
+            if isinstance(result, dict) and self.merge(result):
+                changed = True
+
+        # Only trust the view if it agrees with the successor stabilize keeps
+        _, view_succ = self.find_range((self.node.id + 1) % 2 ** self.node.finger.m) or (None, None)
+        if view_succ and view_succ.id == succ.id:
+            self.refreshed = time.monotonic()
+        else:
+            self.mark_stale()
+        return changed
+
+    # Publish a new sorted snapshot, readers keep using the old one until it is replaced
+    def _rebuild(self):
+        refs = sorted((ChordNodeReference(ip, self.node.port) for ip in self.members), key=lambda ref: ref.id)
+        self.view = ([ref.id for ref in refs], refs)
+
+    def stats(self) -> Dict[str, int]:
+        return {'members': len(self.view[0]), 'fresh': self.is_fresh()}
@@ -0,0 +1,65 @@
+import hashlib
+import threading
+from typing import List, Tuple
+
+from chord.utils import inbetween
+from config import MERKLE_DEPTH
+
+RING_BITS = 160 # Key positions are SHA-1 hashes
+
+# Merkle tree over the ring, split in 2 ** depth buckets of consecutive positions.
+# The hash of a bucket is the XOR of the hashes of its records (key, version, active, value checksum) and every inner
+# node is the XOR of its children, so a write updates the depth + 1 nodes above its key in place.
+# Nodes are numbered as in a heap: the root is 1, the children of n are 2n and 2n + 1.
+class MerkleTree:
+    def __init__(self, depth: int = MERKLE_DEPTH) -> None:
+        self.depth = depth
+        self.leaves = 2 ** depth
+        self.nodes: List[int] = [0] * (2 * self.leaves)
+        self.tree_lock = threading.Lock()
+
+    def bucket(self, position: int) -> int:
+        return position >> (RING_BITS - self.depth)
+
+    # Positions (low, high] of the buckets under a node
+    def span(self, node: int) -> Tuple[int, int]:
+        level = node.bit_length() - 1
+        width = 2 ** (RING_BITS - level)
+        first = (node - 2 ** level) * width
+        return first - 1, first + width - 1
+
+    # Replace the record of a key, old or new are None when the key is added or dropped
+    def update(self, position: int, key: str, old, new):
+        delta = record_hash(key, old) ^ record_hash(key, new)
+        if not delta:
+            return
+        node = self.leaves + self.bucket(position)
+        with self.tree_lock:
+            while node:
+                self.nodes[node] ^= delta
+                node //= 2
+
+    def hashes(self, nodes: List[int]) -> List[int]:
+        return [self.nodes[node] for node in nodes]
+
+    # Whether every position under a node is in the range (start, end]
+    def inside(self, node: int, start: int, end: int) -> bool:
+        low, high = self.span(node)
+        if start == end: # The whole ring
+            return True
+        return inbetween(low + 1, start, end) and inbetween(high, start, end) and not inbetween(start, low + 1, high)
+
+    # Whether some position under a node is in the range (start, end]
+    def overlaps(self, node: int, start: int, end: int) -> bool:
+        low, high = self.span(node)
+        return start == end or inbetween(low + 1, start, end) or inbetween(high, start, end) or inbetween(end, low, high)
+
+def record_hash(key: str, data) -> int:
+    if data is None:
+        return 0
+    digest = hashlib.blake2b(f'{key}\0{data.version}\0{int(data.active)}\0{record_digest(data)}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+# Checksum of the value of a record. A tombstone may still hold the value it removed, it is left out.
+def record_digest(data) -> int:
+    return data.digest() if data.active else 0
@@ -1,19 +1,25 @@
+import asyncio
 import logging
-import socket
 import threading
-import time
+from typing import Any, Callable, Dict, List, Tuple
 
 from chord.constants import *
 from chord.node_reference import ChordNodeReference
 from chord.storage import Data, RAMStorage
-from chord.utils import decode_dict, getShaRepr, inbetween
+from chord.utils import getShaRepr, hash_key, inbetween
 from chord.finger_table import FingerTable
 from chord.discoverer import Discoverer
 from chord.timer import Timer
 from chord.elector import Elector
 from chord.dynamic_list import DynamicList
 from chord.replicator import Replicator
-from config import SEPARATOR
+from chord.routing_cache import RoutingCache
+from chord.membership import Membership
+from chord.replica_reader import ReplicaReader
+from chord.protocol import read_message, write_message
+from chord.worker_pool import WorkerPool
+from chord.transport import every, run, spawn
+from config import CONNECTION_IDLE_TIMEOUT, TOMBSTONE_GC_INTERVAL
 
 # Class representing a Chord node
 class ChordNode:
@@ -31,10 +37,15 @@ class ChordNode:
         self.pred_lock = threading.RLock()
 
         self.shutdown_event = threading.Event()
+        self.next_succ = 0 # Successor to fix next
 
-        threading.Thread(target=self.start_server, daemon=True).start()  # Start server thread
+        self.workers = WorkerPool() # Pool serving incoming requests
+        run(self.start_server())  # Start listening in the event loop
 
         self.finger = FingerTable(self, m) # Finger table
+        self.routes = RoutingCache() # Responsible node of recently used ranges
+        self.membership = Membership(self) # Whole ring view for one hop routing
+        self.reader = ReplicaReader(self) # Policy of the replicas answering get_key
         self.timer = Timer(self) # Node clock
         self.elector = Elector(self, self.timer) # Leader regulator
         self.discoverer = Discoverer(self, self.succ_lock, self.pred_lock, self.elector, self.finger) # Chord ring discoverer
@@ -42,51 +53,61 @@ class ChordNode:
 
         self.discoverer.create_ring_or_join()
 
-        threading.Thread(target=self.stabilize, daemon=True).start() # Start stabilize thread
-        threading.Thread(target=self.check_predecessor, daemon=True).start() # Start check predecessor thread
-        threading.Thread(target=self.check_successor, daemon=True).start() # Start check predecessor thread
-        threading.Thread(target=self.fix_successors, daemon=True).start() # Start fixing successors
-        threading.Thread(target=self.finger.fix_fingers, daemon=True).start() # Start fix fingers thread
-        threading.Thread(target=self.replicator.fix_storage, daemon=True).start() # Start fix storage thread
-        threading.Thread(target=self.discoverer.discover_and_join, daemon=True).start() # Start discovering new rings
-        threading.Thread(target=self.elector.check_leader, daemon=True).start() # Start check leader thread
-        threading.Thread(target=self.discoverer.listen_for_announcements, daemon=True).start() # Start fix fingers thread
-        threading.Thread(target=self.elector.election_thread, daemon=True).start() # Start election thread
-        threading.Thread(target=self.timer.update_time, daemon=True).start() # Start update time thread
+        # Periodic tasks wait in the event loop, their blocking steps share the maintenance threads
+        stop = self.shutdown_event
+        every(10, self.stabilize, stop) # Start stabilize task
+        spawn(self.check_predecessor()) # Start check predecessor task
+        spawn(self.check_successor()) # Start check successor task
+        every(15, self.fix_successors, stop) # Start fixing successors
+        every(10, self.finger.fix_fingers, stop, self.finger.rebuild_event) # Start fix fingers task
+        every(60, self.replicator.fix_storage, stop) # Start fix storage task
+        every(TOMBSTONE_GC_INTERVAL, self.replicator.collect_tombstones, stop) # Start tombstone GC task
+        every(60, self.discoverer.discover_and_join, stop) # Start discovering new rings
+        every(10, self.elector.check_leader, stop) # Start check leader task
+        threading.Thread(target=self.discoverer.listen_for_announcements, daemon=True).start() # Start announcement listener thread
+        every(60, self.elector.election_task, stop) # Start election task
+        spawn(self.timer.update_time()) # Start update time task
 
     # Stabilize method to periodically verify and update the successor and predecessor
     def stabilize(self):
-        while not self.shutdown_event.is_set():
-            try:
-                logging.info('Stabilizing node')
+        try:
+            logging.info('Stabilizing node')
+
+            with self.succ_lock:
+                succ = self.successors.get_index(0)
+            succ_pred = succ.pred
 
+            if (succ.id == self.id and succ_pred.id != self.id) or inbetween(succ_pred.id, self.id, succ.id):
+                logging.info(f'Notifying to {succ_pred}')
                 with self.succ_lock:
-                    succ = self.successors.get_index(0)
-                succ_pred = succ.pred
-
-                if (succ.id == self.id and succ_pred.id != self.id) or inbetween(succ_pred.id, self.id, succ.id):
-                    logging.info(f'Notifying to {succ_pred}')
-                    with self.succ_lock:
-                        self.successors.set_index(0, succ_pred)
-                    if succ_pred.id != self.id:
-                        succ_pred.notify(self.ref)
-                        self.replicator.replicate_all_data(succ_pred)
-
-                if succ.id != self.id:
-                    succ.notify(self.ref)
-                
-                logging.info('Node stabilized')
+                    self.successors.set_index(0, succ_pred)
+                self.finger.request_rebuild()
+                if succ_pred.id != self.id:
+                    succ_pred.notify(self.ref)
+                    self.replicator.replicate_all_data(succ_pred)
 
-            except Exception as e:
-                logging.error(f"Error in stabilize: {e}")
+            if succ.id != self.id:
+                succ.notify(self.ref)
 
-            with self.succ_lock:
-                succ = self.successors.get_index(0)
-            with self.pred_lock:
-                pred = self.predecessors.get_index(0)
-            logging.info(f"Successor: {succ}, Predecessor: {pred}")
+            if self.membership.enabled:
+                with self.succ_lock:
+                    succ = self.successors.get_index(0)
+                if self.membership.gossip(succ):
+                    self.finger.request_rebuild()
+            
+            logging.info('Node stabilized')
+
+        except Exception as e:
+            logging.error(f"Error in stabilize: {e}")
 
-            time.sleep(10)
+        with self.succ_lock:
+            succ = self.successors.get_index(0)
+        with self.pred_lock:
+            pred = self.predecessors.get_index(0)
+        logging.info(f"Successor: {succ}, Predecessor: {pred}")
+        logging.debug(f"Request queue depth: {self.workers.queue_depth()}, workers: {self.workers.thread_count()}, wait by operation: {self.workers.stats()}")
+        logging.debug(f"Routing cache: {self.routes.stats()}, membership: {self.membership.stats()}, reads: {self.reader.stats()}")
+        logging.debug(f"Replication queues: {self.replicator.queue_stats()}, hints: {self.replicator.hint_stats()}")
 
     # Notify method to inform the node about another node
     def notify(self, node: 'ChordNodeReference'):
@@ -100,56 +121,75 @@ class ChordNode:
                     self.predecessors.set_index(0, node)
 
                 self.replicator.new_predecessor_storage()
+                self.finger.request_rebuild()
                 return TRUE
             else:
                 logging.info(f'No update needed for node {node.id}')
                 return FALSE
 
-    # Check successor method to periodically verify if the successor is alive
-    def check_successor(self):
-        while True:
+    # Check successor method to periodically verify if the successors are alive, runs in the event loop.
+    # All of them are pinged at once.
+    async def check_successor(self):
+        while not self.shutdown_event.is_set():
             try:
-                with self.succ_lock:
-                    succ = self.successors.get_index(0)
-                if succ.id != self.id:
-                    logging.info(f'Check successor {succ.id}')
-                    ok = succ.ping()
-                    if not ok:
-                        logging.info(f'Successor {succ.id} has failed')
-                        with self.succ_lock:
-                            succs_len = len(self.successors)
-                            if succs_len == 1:
-                                self.successors.remove_index(0)
-                                self.successors.set_index(0, self.ref)
-                            else:
-                                self.successors.remove_index(0)
+                succs = [succ for succ in self.successors.list if succ.id != self.id]
+                alive = []
+                if succs:
+                    logging.info(f'Check successors {[succ.id for succ in succs]}')
+                    results = await asyncio.gather(*[succ.ping_async() for succ in succs], return_exceptions=True)
+                    failed = [succ for succ, ok in zip(succs, results) if ok is not True]
+                    if failed:
+                        logging.info(f'Successors {[succ.id for succ in failed]} have failed')
+                        # Locks are never taken inside the event loop
+                        await asyncio.to_thread(self.remove_successors, failed)
+                    alive = [succ for succ, ok in zip(succs, results) if ok is True]
+
+                # Successors answering again, and removed ones back, get the writes they missed
+                await asyncio.to_thread(self.replicator.replay_hints, alive)
             except Exception as e:
                 logging.error(f'Error in check successor thread: {e}')
-            time.sleep(10)
+            await asyncio.sleep(10)
+
+    def remove_successors(self, nodes: List[ChordNodeReference]):
+        ids = [node.id for node in nodes]
+        for id in ids:
+            self.routes.invalidate(id)
+            self.membership.remove(id)
+        self.replicator.mark_away(nodes)
 
-    # Check predecessor method to periodically verify if the predecessor is alive
-    def check_predecessor(self):
-        while True:
+        with self.succ_lock:
+            for i in range(len(self.successors) - 1, -1, -1):
+                if self.successors.get_index(i).id in ids:
+                    self.successors.remove_index(i)
+            if len(self.successors) == 0:
+                self.successors.set_index(0, self.ref)
+        self.finger.request_rebuild()
+
+    # Check predecessor method to periodically verify if the predecessor is alive, runs in the event loop
+    async def check_predecessor(self):
+        while not self.shutdown_event.is_set():
             try:
-                with self.pred_lock:
-                    pred = self.predecessors.get_index(0)
+                pred = self.predecessors.get_index(0)
                 if pred and pred.id != self.id:
                     logging.info(f'Check predecessor {pred.id}')
-                    ok = pred.ping()
+                    ok = await pred.ping_async()
                     if not ok:
                         logging.info(f'Predecessor {pred.id} has failed')
-                        with self.pred_lock:
-                            preds_len = len(self.predecessors)
-                            if preds_len == 1:
-                                self.predecessors.remove_index(0)
-                                self.predecessors.set_index(0, self.ref)
-                            else:
-                                self.predecessors.remove_index(0)
+                        await asyncio.to_thread(self.remove_predecessor)
 
                         # self.replicator.fail_predecessor_storage()
             except Exception as e:
                 logging.error(f'Error in check predecessor thread: {e}')
-            time.sleep(10)
+            await asyncio.sleep(10)
+
+    def remove_predecessor(self):
+        with self.pred_lock:
+            preds_len = len(self.predecessors)
+            if preds_len == 1:
+                self.predecessors.remove_index(0)
+                self.predecessors.set_index(0, self.ref)
+            else:
+                self.predecessors.remove_index(0)
 
     def get_successor_and_notify(self, index, ip):
         node = ChordNodeReference(ip, self.port)
@@ -165,18 +205,13 @@ class ChordNode:
         return succ
     
     def fix_successors(self):
-        logging.info('Fix successors thread started')
-
-        next = 0
-        while not self.shutdown_event.is_set():
-            try:
-                succ = self.successors.get_index(0)
-                if succ.id == self.id:
-                    continue
-                next = self.fix_successor(next)
-            except Exception as e:
-                logging.error(f'Error in fix successors thread: {e}')
-            time.sleep(15)
+        try:
+            succ = self.successors.get_index(0)
+            if succ.id == self.id:
+                return
+            self.next_succ = self.fix_successor(self.next_succ)
+        except Exception as e:
+            logging.error(f'Error in fix successors task: {e}')
 
     def fix_successor(self, index: int) -> int:
         logging.info(f'Fixing successor {index}')
@@ -238,128 +273,217 @@ class ChordNode:
                         self.successors.set_index(0, self.ref)
                     return index % len(self.successors)
                 
+    # Whether key falls in the range this node is responsible for
+    def owns(self, key: str) -> bool:
+        pred = self.predecessors.get_index(0)
+        return pred.id == self.id or inbetween(hash_key(key), pred.id, self.id)
+
+    # Run call(succ, check) on the node responsible for key_hash. A cached route, or one taken from the
+    # one hop membership view, is checked by the node and dropped when it is stale or the node fails.
+    # The call is then repeated after a classic finger lookup. Any other answer, False included, means
+    # the node ran the call, so it is returned and never repeated.
+    def route(self, key_hash: int, call: Callable[[ChordNodeReference, bool], Any]) -> Any:
+        succ = self.routes.get(key_hash)
+        if succ:
+            response = self.checked_call(succ, call)
+            if response is not None:
+                return response
+            self.routes.invalidate(succ.id)
+
+        one_hop = self.membership.is_fresh()
+        pred, succ = self.finger.find_range(key_hash)
+        if one_hop:
+            response = self.checked_call(succ, call)
+            if response is not None:
+                self.routes.add(pred.id, succ)
+                return response
+            logging.info(f'Membership view is stale for key {key_hash}')
+            self.membership.mark_stale()
+            pred, succ = self.finger.find_range(key_hash, one_hop=False)
+
+        self.routes.add(pred.id, succ)
+        return call(succ, False)
+
+    # Run call asking succ to refuse keys outside its range, None if it did or failed
+    def checked_call(self, succ: ChordNodeReference, call: Callable[[ChordNodeReference, bool], Any]) -> Any:
+        try:
+            return call(succ, True)
+        except ConnectionError:
+            return None
+
     def get_key(self, key: str) -> str:
         logging.info(f'Get key {key}')
 
-        key_hash = getShaRepr(key)
-        with self.succ_lock:
-            succ = self.finger.find_succ(key_hash)
-        data = succ.retrieve_key(key)
+        key_hash = hash_key(key)
+        data = self.reader.get(key, key_hash)
 
         return data.value
 
     def set_key(self, key: str, value: str) -> bool:
         logging.info(f'Set key {key} with value {value}')
 
-        key_hash = getShaRepr(key)
-        with self.succ_lock:
-            succ = self.finger.find_succ(key_hash)
+        key_hash = hash_key(key)
 
         with self.timer.time_lock:
             time = self.timer.time_counter
 
-        response = succ.store_key(key, value, time, True)
+        response = self.route(key_hash, lambda succ, check: succ.store_key(key, value, time, True, check))
         
         return response
     
     def remove_key(self, key: str) -> bool:
         logging.info(f'Remove key {key}')
 
-        key_hash = getShaRepr(key)
-        with self.succ_lock:
-            succ = self.finger.find_succ(key_hash)
+        key_hash = hash_key(key)
 
         with self.timer.time_lock:
             time = self.timer.time_counter
 
-        response = succ.delete_key(key, time, True)
+        response = self.route(key_hash, lambda succ, check: succ.delete_key(key, time, True, check))
 
         return response
 
-    # Start server method to handle incoming requests
-    def start_server(self):
+    # Group keys by the node responsible for them with one lookup per node instead of one per key
+    def group_keys(self, keys: List[str]) -> Dict[int, Tuple[ChordNodeReference, List[str]]]:
+        groups: Dict[int, Tuple[ChordNodeReference, List[str]]] = {}
+        remaining = [(hash_key(key), key) for key in keys]
+
+        while remaining:
+            key_hash, key = remaining[0]
+            pred, succ = self.finger.find_range(key_hash)
+            self.routes.add(pred.id, succ)
+
+            owned = [key]
+            rest = []
+            for other_hash, other in remaining[1:]:
+                if inbetween(other_hash, pred.id, succ.id):
+                    owned.append(other)
+                else:
+                    rest.append((other_hash, other))
+
+            if succ.id not in groups:
+                groups[succ.id] = (succ, [])
+            groups[succ.id][1].extend(owned)
+            remaining = rest
+
+        return groups
+
+    # Start server method to handle incoming requests, runs in the transport event loop
+    async def start_server(self):
         logging.info('Starting main thread')
-
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.ip, self.port))
-            s.listen(10)
-
-            while True:
-                try:
-                    conn, addr = s.accept()
-
-                    data = conn.recv(1024).decode().split(SEPARATOR)
-
-                    data_resp = None
-                    option = int(data[0])
-
-                    logging.info(f'New connection from {addr}, operation {option}')
-
-                    server_response = ''
-
-                    if option == FIND_SUCCESSOR:
-                        id = int(data[1])
-                        data_resp = self.finger.find_succ(id)
-                    elif option == FIND_PREDECESSOR:
-                        id = int(data[1])
-                        pred = self.finger.find_pred(id)
-                        data_resp = pred if pred else self.ref
-                    elif option == GET_SUCCESSOR:
-                        succ = self.successors.get_index(0)
-                        data_resp = succ if succ else self.ref
-                    elif option == GET_PREDECESSOR:
-                        pred = self.predecessors.get_index(0)
-                        data_resp = pred if pred else self.ref
-                    elif option == NOTIFY:
-                        ip, port = data[1], int(data[2])
-                        self.notify(ChordNodeReference(ip, port))
-                    elif option == CHECK_PREDECESSOR:
-                        pass
-                    elif option == CLOSEST_PRECEDING_FINGER:
-                        id = int(data[1])
-                        data_resp = self.finger.closest_preceding_finger(id)
-                    elif option == STORE_KEY:
-                        key = data[1]
-                        value, version = data[2], int(data[3])
-                        rep = True if int(data[4]) == TRUE else False
-                        server_response = self.replicator.set(key, Data(value, version), rep)
-                    elif option == RETRIEVE_KEY:
-                        key = data[1]
-                        server_response = self.replicator.get(key)
-                    elif option == DELETE_KEY:
-                        key, time = data[1], data[2]
-                        rep = True if int(data[3]) == TRUE else False
-                        server_response = self.replicator.remove(key, time, rep)
-                    elif option == PING:
-                        server_response = ALIVE
-                    elif option == PING_LEADER:
-                        id, time = int(data[1]), int(data[2])
-                        server_response = self.elector.ping_leader(id, time)
-                    elif option == ELECTION:
-                        id, ip, port = int(data[1]), data[2], int(data[3])
-                        server_response = self.elector.election(id, ip, port)
-                    elif option == GET_SUCCESSOR_AND_NOTIFY:
-                        index, ip = int(data[1]), data[2]
-                        data_resp = self.get_successor_and_notify(index, ip)
-                    elif option == SET_PARTITION:
-                        dict = decode_dict(data[1])
-                        version = decode_dict(data[2])
-                        removed_dict = decode_dict(data[3])
-                        server_response = self.replicator.set_partition(dict, version, removed_dict)
-                    elif option == RESOLVE_DATA:
-                        dict = decode_dict(data[1])
-                        version = decode_dict(data[2])
-                        removed_dict = decode_dict(data[3])
-                        server_response = self.replicator.resolve_data(dict, version, removed_dict)
-
-                    response = None
-                    if data_resp:
-                        response = f'{data_resp.id}{SEPARATOR}{data_resp.ip}'.encode()
-                    else:
-                        response = f'{server_response}'.encode()
-
-                    conn.sendall(response)
-                    conn.close()
-                except Exception as e:
-                    logging.error(f'Error in main thread: {e}')
\ No newline at end of file
+        await asyncio.start_server(self.serve_connection, self.ip, self.port, reuse_address=True, backlog=128)
+
+    # Read every request sent through a connection until the peer closes it and hand them to the workers
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info('peername')
+        try:
+            while not self.shutdown_event.is_set():
+                request = await asyncio.wait_for(read_message(reader), 2 * CONNECTION_IDLE_TIMEOUT)
+                if request is None:
+                    break
+
+                option, request_id, data = request
+                result = await self.workers.submit(option, self.handle_request, option, data, addr)
+                result.add_done_callback(lambda result, option=option, request_id=request_id: self.send_response(writer, option, request_id, result))
+        except (OSError, ValueError, ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    def send_response(self, writer: asyncio.StreamWriter, option: int, request_id: int, result: asyncio.Future):
+        if writer.is_closing():
+            return
+
+        response = [] if result.exception() else result.result()
+        write_message(writer, option, request_id, response)
+
+    def handle_request(self, option: int, data: List, addr) -> List:
+        data_resp = None
+
+        logging.info(f'New request from {addr}, operation {option}')
+
+        server_response = None
+
+        if option == FIND_SUCCESSOR:
+            id = data[0]
+            data_resp = self.finger.find_succ(id)
+        elif option == FIND_PREDECESSOR:
+            id = data[0]
+            pred = self.finger.find_pred(id)
+            data_resp = pred if pred else self.ref
+        elif option == GET_SUCCESSOR:
+            succ = self.successors.get_index(0)
+            data_resp = succ if succ else self.ref
+        elif option == GET_SUCCESSORS:
+            with self.succ_lock:
+                successors = list(self.successors.list)
+            return [[[succ.ip, succ.port] for succ in successors]]
+        elif option == GET_PREDECESSOR:
+            pred = self.predecessors.get_index(0)
+            data_resp = pred if pred else self.ref
+        elif option == NOTIFY:
+            ip, port = data[0], data[1]
+            self.notify(ChordNodeReference(ip, port))
+        elif option == CHECK_PREDECESSOR:
+            pass
+        elif option == CLOSEST_PRECEDING_FINGER:
+            id = data[0]
+            data_resp = self.finger.closest_preceding_finger(id)
+        elif option == STORE_KEY:
+            key, value, version, rep, check = data
+            if check and not self.owns(key):
+                return [NOT_RESPONSIBLE]
+            server_response = self.replicator.set(key, Data(value, version), rep)
+        elif option == RETRIEVE_KEY:
+            key, check = data
+            if check and not self.owns(key):
+                return [NOT_RESPONSIBLE]
+            return list(self.replicator.get(key))
+        elif option == DELETE_KEY:
+            key, time, rep, check = data
+            if check and not self.owns(key):
+                return [NOT_RESPONSIBLE]
+            server_response = self.replicator.remove(key, time, rep)
+        elif option == PING:
+            server_response = ALIVE
+        elif option == PING_LEADER:
+            id, time = data
+            server_response = self.elector.ping_leader(id, time)
+        elif option == ELECTION:
+            id, ip, port = data
+            data_resp = self.elector.election(id, ip, port)
+        elif option == GET_SUCCESSOR_AND_NOTIFY:
+            index, ip = data
+            data_resp = self.get_successor_and_notify(index, ip)
+        elif option == SET_PARTITION:
+            dict, version, removed_dict = data
+            server_response = self.replicator.set_partition(dict, version, removed_dict)
+        elif option == RESOLVE_DATA:
+            dict, version, removed_dict = data
+            return self.replicator.resolve_data(dict, version, removed_dict)
+        elif option == RETRIEVE_MANY:
+            keys, check = data
+            if check and not all(self.owns(key) for key in keys):
+                return [NOT_RESPONSIBLE]
+            return [self.replicator.get_many(keys)]
+        elif option == STORE_MANY:
+            values, rep = data
+            items = {key: Data(value, version) for key, (value, version) in values.items()}
+            server_response = self.replicator.set_many(items, rep)
+        elif option == DELETE_MANY:
+            times, rep = data
+            server_response = self.replicator.remove_many(times, rep)
+        elif option == EXCHANGE_MEMBERS:
+            self.membership.merge(data[0])
+            server_response = self.membership.table()
+        elif option == PURGE_KEYS:
+            server_response = self.replicator.purge(data[0])
+        elif option == MERKLE_HASHES:
+            return [self.replicator.merkle_hashes(data[0])]
+        elif option == MERKLE_KEYS:
+            buckets, start, end = data
+            return [self.replicator.merkle_keys(buckets, start, end)]
+
+        if data_resp:
+            return [data_resp.ip, data_resp.port]
+        return [] if server_response is None else [server_response]
@@ -1,108 +1,259 @@
+import itertools
 import logging
-import socket
+import time
 import traceback
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from chord.constants import *
+from chord.connection_pool import ConnectionPool
+from chord.transport import run
 from chord.utils import getShaRepr
-from config import PORT, SEPARATOR
+from config import CONNECTION_TIMEOUT, PORT
 from chord.storage import Data
 
-# Class to reference a Chord node
+# Channels to the other nodes are shared by every reference
+pool = ConnectionPool()
+request_ids = itertools.count(1)
+
+# Class to reference a Chord node.
+# Every request has an async version for the event loop and a blocking one for the rest of the server.
 class ChordNodeReference:
     def __init__(self, ip: str, port: int = PORT):
         self.id = getShaRepr(ip)
         self.ip = ip
         self.port = port
 
-    # Internal method to send data to the referenced node
-    def _send_data(self, op: int, data: str = None) -> bytes:
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(3)
-                s.connect((self.ip, int(self.port)))
-                s.sendall(f'{op}{SEPARATOR}{data}'.encode('utf-8'))
-                return s.recv(1024)
-        except Exception as e:
-            logging.error(f"Error sending data to {self.ip}: {e}, operation: {op}, data: {data}")
-            # traceback.print_exc()
-            return b''
+    # Internal method to send data to the referenced node, returns None if the request failed
+    async def _send_data_async(self, op: int, *fields) -> List:
+        request_id = next(request_ids) & 0xFFFFFFFF
+        for attempt in range(2):
+            channel = None
+            try:
+                channel = await pool.get(self.ip, self.port)
+                start = time.monotonic()
+                response = await channel.request(op, request_id, list(fields), CONNECTION_TIMEOUT)
+                pool.observe(channel.peer, time.monotonic() - start)
+                return response
+            except Exception as e:
+                # A kept alive channel may have been closed by the peer, retry once on a new one
+                if isinstance(e, ConnectionError) and channel and channel.uses > 1 and attempt == 0:
+                    continue
+                logging.error(f"Error sending data to {self.ip}: {e!r}, operation: {op}")
+                # traceback.print_exc()
+                return None
+
+    def _send_data(self, op: int, *fields) -> List:
+        return run(self._send_data_async(op, *fields))
+
+    # Build a reference from an (ip, port) response
+    def _reference(self, response: List, op: int) -> 'ChordNodeReference':
+        if not response:
+            raise ConnectionError(f'Operation {op} failed in {self.ip}')
+        return ChordNodeReference(response[0], response[1])
+
+    def _ok(self, response: List) -> bool:
+        return bool(response) and response[0] == TRUE
+
+    # Like _ok, but None when the node answered that the key is not in its range. A checked request
+    # without answer raises ConnectionError, so only a FALSE status reads as False.
+    def _status(self, response: List, op: int, check: bool) -> bool:
+        if not response and check:
+            raise ConnectionError(f'Operation {op} failed in {self.ip}')
+        if response and response[0] == NOT_RESPONSIBLE:
+            return None
+        return self._ok(response)
 
     # Method to find the successor of a given id
+    async def find_successor_async(self, id: int) -> 'ChordNodeReference':
+        return self._reference(await self._send_data_async(FIND_SUCCESSOR, id), FIND_SUCCESSOR)
+
     def find_successor(self, id: int) -> 'ChordNodeReference':
-        response = self._send_data(FIND_SUCCESSOR, str(id)).decode().split(SEPARATOR)
-        return ChordNodeReference(response[1], self.port)
+        return run(self.find_successor_async(id))
+
+    # Method to get the successor list of the current node, the nodes holding its replicas
+    async def get_successors_async(self) -> List['ChordNodeReference']:
+        response = await self._send_data_async(GET_SUCCESSORS)
+        if not response:
+            raise ConnectionError(f'Error getting the successors of {self.ip}')
+        return [ChordNodeReference(ip, port) for ip, port in response[0]]
+
+    def get_successors(self) -> List['ChordNodeReference']:
+        return run(self.get_successors_async())
 
     # Method to find the predecessor of a given id
+    async def find_predecessor_async(self, id: int) -> 'ChordNodeReference':
+        return self._reference(await self._send_data_async(FIND_PREDECESSOR, id), FIND_PREDECESSOR)
+
     def find_predecessor(self, id: int) -> 'ChordNodeReference':
-        response = self._send_data(FIND_PREDECESSOR, str(id)).decode().split(SEPARATOR)
-        return ChordNodeReference(response[1], self.port)
+        return run(self.find_predecessor_async(id))
+
+    # Method to get the successor of the current node
+    async def get_succ_async(self) -> 'ChordNodeReference':
+        return self._reference(await self._send_data_async(GET_SUCCESSOR), GET_SUCCESSOR)
 
-    # Property to get the successor of the current node
     @property
     def succ(self) -> 'ChordNodeReference':
-        response = self._send_data(GET_SUCCESSOR).decode().split(SEPARATOR)
-        return ChordNodeReference(response[1], self.port)
+        return run(self.get_succ_async())
+
+    # Method to get the predecessor of the current node
+    async def get_pred_async(self) -> 'ChordNodeReference':
+        return self._reference(await self._send_data_async(GET_PREDECESSOR), GET_PREDECESSOR)
 
-    # Property to get the predecessor of the current node
     @property
     def pred(self) -> 'ChordNodeReference':
-        response = self._send_data(GET_PREDECESSOR).decode().split(SEPARATOR)
-        return ChordNodeReference(response[1], self.port)
+        return run(self.get_pred_async())
 
     # Method to notify the current node about another node
+    async def notify_async(self, node: 'ChordNodeReference'):
+        await self._send_data_async(NOTIFY, node.ip, node.port)
+
     def notify(self, node: 'ChordNodeReference'):
-        self._send_data(NOTIFY, f'{node.ip}{SEPARATOR}{node.port}')
+        run(self.notify_async(node))
 
     # Method to check if the predecessor is alive
+    async def check_predecessor_async(self):
+        await self._send_data_async(CHECK_PREDECESSOR)
+
     def check_predecessor(self):
-        self._send_data(CHECK_PREDECESSOR)
+        run(self.check_predecessor_async())
 
     # Method to find the closest preceding finger of a given id
+    async def closest_preceding_finger_async(self, id: int) -> 'ChordNodeReference':
+        return self._reference(await self._send_data_async(CLOSEST_PRECEDING_FINGER, id), CLOSEST_PRECEDING_FINGER)
+
     def closest_preceding_finger(self, id: int) -> 'ChordNodeReference':
-        response = self._send_data(CLOSEST_PRECEDING_FINGER, str(id)).decode().split(SEPARATOR)
-        return ChordNodeReference(response[1], self.port)
-
-    # Method to retrieve a value for a given key from the current node
-    def retrieve_key(self, key: str) -> Data:
-        response = self._send_data(RETRIEVE_KEY, key).decode().split(SEPARATOR)
-        return Data(response[0], int(response[1]))
-    
+        return run(self.closest_preceding_finger_async(id))
+
+    # Method to retrieve a value for a given key from the current node.
+    # With check the node refuses keys outside its range and None is returned.
+    async def retrieve_key_async(self, key: str, check: bool = False) -> Data:
+        response = await self._send_data_async(RETRIEVE_KEY, key, check)
+        if not response:
+            raise ConnectionError(f'Error retrieving key {key} from {self.ip}')
+        if response[0] == NOT_RESPONSIBLE:
+            return None
+        return Data(response[0], response[1])
+
+    def retrieve_key(self, key: str, check: bool = False) -> Data:
+        return run(self.retrieve_key_async(key, check))
+
     # Method to store a key-value pair in the current node
-    def store_key(self, key: str, value: str, version: int, rep: bool = False) -> bool:
-        response = self._send_data(STORE_KEY, f'{key}{SEPARATOR}{value}{SEPARATOR}{version}{SEPARATOR}{TRUE if rep else FALSE}').decode()
-        return False if response == '' else int(response) == TRUE
-    
+    async def store_key_async(self, key: str, value: str, version: int, rep: bool = False, check: bool = False) -> bool:
+        return self._status(await self._send_data_async(STORE_KEY, key, value, version, rep, check), STORE_KEY, check)
+
+    def store_key(self, key: str, value: str, version: int, rep: bool = False, check: bool = False) -> bool:
+        return run(self.store_key_async(key, value, version, rep, check))
+
     # Method to delete a key-value pair in the current node
-    def delete_key(self, key: str, time: int, rep: bool = False) -> bool: 
-        response = self._send_data(DELETE_KEY, f'{key}{SEPARATOR}{time}{SEPARATOR}{TRUE if rep else FALSE}').decode()
-        return False if response == '' else int(response) == TRUE
-    
+    async def delete_key_async(self, key: str, time: int, rep: bool = False, check: bool = False) -> bool:
+        return self._status(await self._send_data_async(DELETE_KEY, key, time, rep, check), DELETE_KEY, check)
+
+    def delete_key(self, key: str, time: int, rep: bool = False, check: bool = False) -> bool:
+        return run(self.delete_key_async(key, time, rep, check))
+
+    async def ping_async(self) -> bool:
+        response = await self._send_data_async(PING)
+        return bool(response) and response[0] == ALIVE
+
     def ping(self) -> bool:
-        response = self._send_data(PING).decode()
-        return response == ALIVE
-    
-    def ping_leader(self, id: int, time: int):
-        response = self._send_data(PING_LEADER, f'{id}{SEPARATOR}{time}').decode()
-        return int(response)
-
-    def election(self, first_id: int, leader_ip: int, leader_port: int) -> 'ChordNodeReference':
-        response = self._send_data(ELECTION, f'{first_id}{SEPARATOR}{leader_ip}{SEPARATOR}{leader_port}').decode().split(SEPARATOR)
-        return ChordNodeReference(response[0], response[1])
-    
+        return run(self.ping_async())
+
+    async def ping_leader_async(self, id: int, time: int) -> int:
+        response = await self._send_data_async(PING_LEADER, id, time)
+        return int(response[0])
+
+    def ping_leader(self, id: int, time: int) -> int:
+        return run(self.ping_leader_async(id, time))
+
+    async def election_async(self, first_id: int, leader_ip: str, leader_port: int) -> 'ChordNodeReference':
+        return self._reference(await self._send_data_async(ELECTION, first_id, leader_ip, leader_port), ELECTION)
+
+    def election(self, first_id: int, leader_ip: str, leader_port: int) -> 'ChordNodeReference':
+        return run(self.election_async(first_id, leader_ip, leader_port))
+
+    async def get_successor_and_notify_async(self, index, ip) -> 'ChordNodeReference':
+        return self._reference(await self._send_data_async(GET_SUCCESSOR_AND_NOTIFY, index, ip), GET_SUCCESSOR_AND_NOTIFY)
+
     def get_successor_and_notify(self, index, ip) -> 'ChordNodeReference':
-        response = self._send_data(GET_SUCCESSOR_AND_NOTIFY, f'{index}{SEPARATOR}{ip}').decode().split(SEPARATOR)
-        return ChordNodeReference(response[1], self.port)
-    
-    def set_partition(self, dict: str, version: str, remove: str) -> bool:
-        response = self._send_data(SET_PARTITION, f'{dict}{SEPARATOR}{version}{SEPARATOR}{remove}').decode()
-        return False if response == '' else int(response) == TRUE
-    
-    def resolve_data(self, dict: str, version: str, remove: str) -> Tuple[List[str], bool]:
-        response = self._send_data(RESOLVE_DATA, f'{dict}{SEPARATOR}{version}{SEPARATOR}{remove}').decode().split(SEPARATOR)
-        return response, len(response) > 1
+        return run(self.get_successor_and_notify_async(index, ip))
+
+    async def set_partition_async(self, dict: Dict[str, str], version: Dict[str, int], remove: Dict[str, int]) -> bool:
+        return self._ok(await self._send_data_async(SET_PARTITION, dict, version, remove))
+
+    def set_partition(self, dict: Dict[str, str], version: Dict[str, int], remove: Dict[str, int]) -> bool:
+        return run(self.set_partition_async(dict, version, remove))
+
+    async def resolve_data_async(self, dict: Dict[str, str], version: Dict[str, int], remove: Dict[str, int]) -> Tuple[List[Dict], bool]:
+        response = await self._send_data_async(RESOLVE_DATA, dict, version, remove)
+        return response, bool(response) and len(response) == 3
+
+    def resolve_data(self, dict: Dict[str, str], version: Dict[str, int], remove: Dict[str, int]) -> Tuple[List[Dict], bool]:
+        return run(self.resolve_data_async(dict, version, remove))
+
+    # Batched versions of retrieve_key, store_key and delete_key, one message for many keys.
+    # With check the node refuses the whole batch unless it owns every key and None is returned.
+    async def retrieve_many_async(self, keys: List[str], check: bool = False) -> Dict[str, Data]:
+        response = await self._send_data_async(RETRIEVE_MANY, keys, check)
+        if not response:
+            raise ConnectionError(f'Error retrieving {len(keys)} keys from {self.ip}')
+        if response[0] == NOT_RESPONSIBLE:
+            return None
+        return {key: Data(value, version) for key, (value, version) in response[0].items()}
+
+    def retrieve_many(self, keys: List[str], check: bool = False) -> Dict[str, Data]:
+        return run(self.retrieve_many_async(keys, check))
+
+    async def store_many_async(self, items: Dict[str, Data], rep: bool = False) -> bool:
+        values = {key: [data.value, data.version] for key, data in items.items()}
+        return self._ok(await self._send_data_async(STORE_MANY, values, rep))
+
+    def store_many(self, items: Dict[str, Data], rep: bool = False) -> bool:
+        return run(self.store_many_async(items, rep))
+
+    async def delete_many_async(self, times: Dict[str, int], rep: bool = False) -> bool:
+        return self._ok(await self._send_data_async(DELETE_MANY, times, rep))
+
+    def delete_many(self, times: Dict[str, int], rep: bool = False) -> bool:
+        return run(self.delete_many_async(times, rep))
+
+    # Drop tombstones, keys written after the given versions are kept
+    async def purge_keys_async(self, versions: Dict[str, int]) -> bool:
+        return self._ok(await self._send_data_async(PURGE_KEYS, versions))
+
+    def purge_keys(self, versions: Dict[str, int]) -> bool:
+        return run(self.purge_keys_async(versions))
+
+    # Hashes of the given nodes of the Merkle tree of the referenced node
+    async def merkle_hashes_async(self, nodes: List[int]) -> List[int]:
+        response = await self._send_data_async(MERKLE_HASHES, nodes)
+        if not response:
+            raise ConnectionError(f'Error reading Merkle hashes from {self.ip}')
+        return response[0]
+
+    def merkle_hashes(self, nodes: List[int]) -> List[int]:
+        return run(self.merkle_hashes_async(nodes))
+
+    # Versions, states and value checksums [version, active, checksum] of the keys in the given Merkle buckets with position in (start, end]
+    async def merkle_keys_async(self, buckets: List[int], start: int, end: int) -> Dict[str, List]:
+        response = await self._send_data_async(MERKLE_KEYS, buckets, start, end)
+        if not response:
+            raise ConnectionError(f'Error reading Merkle keys from {self.ip}')
+        return response[0]
+
+    def merkle_keys(self, buckets: List[int], start: int, end: int) -> Dict[str, List]:
+        return run(self.merkle_keys_async(buckets, start, end))
+
+    # Send our membership heartbeats and get the ones of the referenced node
+    async def exchange_members_async(self, table: Dict[str, int]) -> Dict[str, int]:
+        response = await self._send_data_async(EXCHANGE_MEMBERS, table)
+        if not response:
+            raise ConnectionError(f'Error exchanging members with {self.ip}')
+        return response[0]
+
+    def exchange_members(self, table: Dict[str, int]) -> Dict[str, int]:
+        return run(self.exchange_members_async(table))
 
     def __str__(self) -> str:
         return f'{self.id},{self.ip},{self.port}'
 
     def __repr__(self) -> str:
-        return str(self)
\ No newline at end of file
+        return str(self)
@@ -0,0 +1,156 @@
+import asyncio
+import struct
+from typing import Any, List, Optional, Tuple
+
+from config import MAX_FRAME_SIZE
+
+# Frame layout: length (4 bytes) | operation (1 byte) | request id (4 bytes) | fields
+LENGTH = struct.Struct('!I')
+HEADER = struct.Struct('!BI')
+COUNT = struct.Struct('!I')
+INT_SIZE = struct.Struct('!H')
+
+# Field type tags
+NONE_FIELD = 0
+FALSE_FIELD = 1
+TRUE_FIELD = 2
+INT_FIELD = 3
+STR_FIELD = 4
+BYTES_FIELD = 5
+LIST_FIELD = 6
+DICT_FIELD = 7
+
+Message = Tuple[int, int, List[Any]]
+
+# UTF-8 text that is already encoded, sent as a str field without decoding it first
+class EncodedStr:
+    __slots__ = ('raw',)
+
+    def __init__(self, raw: memoryview) -> None:
+        self.raw = raw
+
+def _encode_field(buffer: bytearray, value: Any):
+    if value is None:
+        buffer.append(NONE_FIELD)
+    elif value is True:
+        buffer.append(TRUE_FIELD)
+    elif value is False:
+        buffer.append(FALSE_FIELD)
+    elif isinstance(value, int):
+        raw = value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True)
+        buffer.append(INT_FIELD)
+        buffer += INT_SIZE.pack(len(raw))
+        buffer += raw
+    elif isinstance(value, str):
+        raw = value.encode('utf-8')
+        buffer.append(STR_FIELD)
+        buffer += COUNT.pack(len(raw))
+        buffer += raw
+    elif isinstance(value, EncodedStr):
+        buffer.append(STR_FIELD)
+        buffer += COUNT.pack(len(value.raw))
+        buffer += value.raw
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        buffer.append(BYTES_FIELD)
+        buffer += COUNT.pack(len(value))
+        buffer += value
+    elif isinstance(value, (list, tuple)):
+        buffer.append(LIST_FIELD)
+        buffer += COUNT.pack(len(value))
+        for item in value:
+            _encode_field(buffer, item)
+    elif isinstance(value, dict):
+        buffer.append(DICT_FIELD)
+        buffer += COUNT.pack(len(value))
+        for key, item in value.items():
+            _encode_field(buffer, key)
+            _encode_field(buffer, item)
+    else:
+        raise TypeError(f'Field of type {type(value).__name__} can not be encoded')
+
+def _decode_field(view: memoryview, offset: int) -> Tuple[Any, int]:
+    tag = view[offset]
+    offset += 1
+
+    if tag == NONE_FIELD:
+        return None, offset
+    if tag == TRUE_FIELD:
+        return True, offset
+    if tag == FALSE_FIELD:
+        return False, offset
+    if tag == INT_FIELD:
+        (size,) = INT_SIZE.unpack_from(view, offset)
+        offset += INT_SIZE.size
+        return int.from_bytes(view[offset:offset + size], 'big', signed=True), offset + size
+    if tag == STR_FIELD or tag == BYTES_FIELD:
+        (size,) = COUNT.unpack_from(view, offset)
+        offset += COUNT.size
+        raw = view[offset:offset + size]
+        value = str(raw, 'utf-8') if tag == STR_FIELD else bytes(raw)
+        return value, offset + size
+    if tag == LIST_FIELD:
+        (count,) = COUNT.unpack_from(view, offset)
+        offset += COUNT.size
+        items = []
+        for _ in range(count):
+            item, offset = _decode_field(view, offset)
+            items.append(item)
+        return items, offset
+    if tag == DICT_FIELD:
+        (count,) = COUNT.unpack_from(view, offset)
+        offset += COUNT.size
+        items = {}
+        for _ in range(count):
+            key, offset = _decode_field(view, offset)
+            items[key], offset = _decode_field(view, offset)
+        return items, offset
+
+    raise ValueError(f'Unknown field type {tag}')
+
+# Append the fields to buffer, also used for the records of the storage log
+def encode_fields(buffer: bytearray, fields: List[Any]) -> bytearray:
+    for field in fields:
+        _encode_field(buffer, field)
+    return buffer
+
+def decode_fields(view: memoryview, offset: int = 0) -> List[Any]:
+    fields = []
+    while offset < len(view):
+        field, offset = _decode_field(view, offset)
+        fields.append(field)
+    return fields
+
+# Build the whole frame in one buffer so it leaves with a single send
+def encode_message(op: int, request_id: int, fields: List[Any]) -> bytearray:
+    buffer = bytearray(LENGTH.size)
+    buffer += HEADER.pack(op, request_id)
+    encode_fields(buffer, fields)
+    LENGTH.pack_into(buffer, 0, len(buffer) - LENGTH.size)
+    return buffer
+
+def decode_message(payload) -> Message:
+    view = memoryview(payload)
+    op, request_id = HEADER.unpack_from(view, 0)
+    return op, request_id, decode_fields(view, HEADER.size)
+
+# Returns None when the peer closed the connection between two messages.
+# A frame longer than max_size raises ConnectionError before it is read, the caller closes the connection.
+async def read_message(reader: asyncio.StreamReader, max_size: int = MAX_FRAME_SIZE) -> Optional[Message]:
+    try:
+        header = await reader.readexactly(LENGTH.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError('Connection closed in the middle of a message')
+        return None
+
+    (length,) = LENGTH.unpack(header)
+    if length > max_size or length < HEADER.size:
+        raise ConnectionError(f'Frame of {length} bytes, the limit is {max_size}')
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError('Connection closed in the middle of a message')
+    return decode_message(payload)
+
+def write_message(writer: asyncio.StreamWriter, op: int, request_id: int, fields: List[Any]):
+    writer.write(encode_message(op, request_id, fields))
@@ -0,0 +1,106 @@
+import logging
+import random
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from chord.node_reference import ChordNodeReference, pool
+from chord.storage import Data
+from chord.transport import run, run_until
+from config import READ_POLICY, REPLICA_SET_TTL
+
+# Reads of get_key spread over the replicas of a key: its primary and the successors of the primary.
+# Policies:
+#   primary       only the primary answers, as every read did before
+#   nearest       the replica with the lowest average round trip
+#   least_loaded  the replica with the fewest requests of this node waiting, ties broken at random
+#   quorum        a majority of the replicas, the highest version wins
+# A replica may not have the last writes yet, a read it answers empty goes to the primary.
+# Any failure falls back to reading from the primary.
+class ReplicaReader:
+    def __init__(self, node, policy: str = READ_POLICY, ttl: int = REPLICA_SET_TTL) -> None:
+        self.node = node
+        self.policy = policy
+        self.ttl = ttl
+
+        self.replica_sets: Dict[int, Tuple[float, List[ChordNodeReference]]] = {} # Primary id -> (expiry, replicas)
+        self.sets_lock = threading.Lock()
+
+        self.reads = {'primary': 0, 'replica': 0, 'quorum': 0, 'fallback': 0}
+
+    def get(self, key: str, key_hash: int) -> Data:
+        if self.policy != 'primary':
+            try:
+                data = self.read_replicas(key, key_hash)
+                if data is not None:
+                    return data
+            except Exception as e:
+                logging.info(f'Error reading key {key} from replicas: {e}')
+            self.count('fallback')
+        else:
+            self.count('primary')
+
+        return self.node.route(key_hash, lambda succ, check: succ.retrieve_key(key, check))
+
+    # Data of the key as the policy reads it, None if the primary must be asked
+    def read_replicas(self, key: str, key_hash: int) -> Data:
+        primary, replicas = self.replicas(key_hash)
+
+        if self.policy == 'quorum':
+            quorum = len(replicas) // 2 + 1
+            results = run_until([replica.retrieve_key_async(key) for replica in replicas], quorum, lambda result: isinstance(result, Data))
+            answers = [result for result in results if isinstance(result, Data)]
+            if len(answers) < quorum:
+                self.forget(primary.id)
+                return None
+            self.count('quorum')
+            return max(answers, key=lambda data: data.version)
+
+        replica = self.choose(replicas)
+        try:
+            data = replica.retrieve_key(key)
+        except ConnectionError:
+            self.forget(primary.id)
+            return None
+        if data.version == 0 and replica.id != primary.id:
+            return None
+        self.count('replica')
+        return data
+
+    # Primary of a key and every node holding it, the primary first
+    def replicas(self, key_hash: int) -> Tuple[ChordNodeReference, List[ChordNodeReference]]:
+        primary = self.node.routes.get(key_hash)
+        if primary is None:
+            pred, primary = self.node.finger.find_range(key_hash)
+            self.node.routes.add(pred.id, primary)
+
+        now = time.monotonic()
+        with self.sets_lock:
+            expiry, replicas = self.replica_sets.get(primary.id, (0.0, None))
+        if replicas is None or expiry < now:
+            successors = primary.get_successors()
+            replicas = list({node.id: node for node in [primary] + successors}.values())
+            with self.sets_lock:
+                self.replica_sets[primary.id] = (now + self.ttl, replicas)
+
+        return primary, replicas
+
+    # Replica to read from, chosen in the event loop where the connection pool lives
+    def choose(self, replicas: List[ChordNodeReference]) -> ChordNodeReference:
+        async def choose():
+            if self.policy == 'nearest':
+                return min(replicas, key=lambda replica: (pool.rtt(replica.ip, replica.port), random.random()))
+            return min(replicas, key=lambda replica: (pool.in_flight(replica.ip, replica.port), random.random()))
+        return run(choose())
+
+    def count(self, kind: str):
+        with self.sets_lock:
+            self.reads[kind] += 1
+
+    def forget(self, id: int):
+        with self.sets_lock:
+            self.replica_sets.pop(id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self.sets_lock:
+            return dict(self.reads, policy=self.policy)
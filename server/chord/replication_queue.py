@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+from chord.node_reference import ChordNodeReference
+from chord.transport import submit
+from config import REPLICATION_BATCH, REPLICATION_QUEUE_SIZE, REPLICATION_QUEUE_TIMEOUT, REPLICATION_RETRY
+
+# Writes waiting to be replicated in one successor, drained in the shared maintenance threads one
+# message of up to batch consecutive writes at a time, so every queue gets its turn and an idle one
+# holds no thread. Writers wait while the queue is full, and if the successor is still too slow after
+# timeout seconds the queue is dropped: the next drain then catches the successor up from the
+# replication log, so a slow successor slows writes down for a while but never stops them.
+class ReplicationQueue:
+    def __init__(self, replicator, succ: ChordNodeReference, size: int = REPLICATION_QUEUE_SIZE, batch: int = REPLICATION_BATCH, timeout: float = REPLICATION_QUEUE_TIMEOUT) -> None:
+        self.replicator = replicator
+        self.succ = succ
+        self.size = size
+        self.batch = batch
+        self.timeout = timeout
+
+        self.entries: Deque[Tuple[int, str, float]] = deque() # (sequence, key, time it was queued)
+        self.queue_lock = threading.Condition()
+        self.behind = False # Writes were dropped, the successor must be caught up from the log
+        self.scheduled = False # A drain is queued, running or waiting to retry
+        self.closed = False
+
+        self.sent = 0
+        self.overflows = 0
+
+    # Backpressure: wait until count more writes fit, or drop the queue after timeout
+    def wait_room(self, count: int):
+        with self.queue_lock:
+            if self.queue_lock.wait_for(lambda: self.closed or len(self.entries) + count <= self.size, self.timeout):
+                return
+            logging.warning(f'Replication queue of {self.succ.ip} full for {self.timeout}s, dropping {len(self.entries)} writes')
+            self.entries.clear()
+            self.behind = True
+            self.overflows += 1
+            self.queue_lock.notify_all()
+            self.schedule()
+
+    # Queue the writes of keys numbered from first, called in the order of the sequences
+    def put(self, first: int, keys: List[str]):
+        now = time.monotonic()
+        with self.queue_lock:
+            if self.closed:
+                return
+            self.entries.extend((first + i, key, now) for i, key in enumerate(keys))
+            self.queue_lock.notify_all()
+            self.schedule()
+
+    # Queue a drain if there is something to send and none is pending, called holding queue_lock
+    def schedule(self):
+        if not self.scheduled and not self.closed and (self.entries or self.behind):
+            self.scheduled = True
+            submit(self.drain)
+
+    # Send one batch, then queue the next drain. A failed one is retried after REPLICATION_RETRY.
+    def drain(self):
+        with self.queue_lock:
+            if self.closed:
+                self.scheduled = False
+                return
+            behind, self.behind = self.behind, False
+            batch = [self.entries.popleft() for _ in range(min(self.batch, len(self.entries)))]
+            self.queue_lock.notify_all() # Room for the writers
+
+        try:
+            if behind and not self.replicator.replicate_all_data(self.succ):
+                raise ConnectionError(f'Error catching up {self.succ.ip}')
+            if batch:
+                self.replicator.push_writes(self.succ, [key for _, key, _ in batch], batch[0][0], batch[-1][0])
+                self.sent += len(batch)
+        except Exception as e:
+            logging.error(f'Error replicating {len(batch)} writes in {self.succ.ip}: {e}')
+            with self.queue_lock:
+                self.behind = True
+            submit(self.drain, REPLICATION_RETRY)
+            return
+
+        with self.queue_lock:
+            self.scheduled = False
+            self.schedule()
+
+    def close(self):
+        with self.queue_lock:
+            self.closed = True
+            self.entries.clear()
+            self.queue_lock.notify_all()
+
+    # Depth in writes, age in seconds of the oldest write queued and lag in writes the successor
+    # is known to miss, None before its first replication
+    def stats(self) -> Dict[str, int]:
+        with self.queue_lock:
+            depth = len(self.entries)
+            age = time.monotonic() - self.entries[0][2] if self.entries else 0.0
+        return {'depth': depth, 'age': round(age, 3), 'lag': self.replicator.lag(self.succ.id), 'sent': self.sent, 'overflows': self.overflows}
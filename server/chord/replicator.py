@@ -1,93 +1,366 @@
+import asyncio
 import logging
+import threading
 import time
-from typing import Dict
-from chord.storage import Data, DefaultData, RAMStorage, Storage
+from collections import deque
+from typing import Callable, Coroutine, Deque, Dict, Iterable, List, Optional, Set, Tuple
+from chord.storage import EMPTY_DATA, Data, Storage, create_storage
 from chord.node_reference import ChordNodeReference
 from chord.constants import FALSE, TRUE
 from chord.dynamic_list import DynamicList
-from chord.utils import code_dict, decode_dict, getShaRepr, inbetween
+from chord.merkle import record_digest
+from chord.replication_queue import ReplicationQueue
 from chord.timer import Timer
-from config import SEPARATOR
+from chord.transport import run_all, run_until
+from chord.utils import inbetween
+from config import HINT_LIMIT, HINT_TTL, REPLICATION_ACK, REPLICATION_BATCH, REPLICATION_LOG_SIZE, REPLICATION_MODE, TOMBSTONE_GRACE
 
+ACK_LEVELS = ('none', 'one', 'quorum', 'all')
+REPLICATION_MODES = ('sync', 'async')
 
 class Replicator:
-    def __init__(self, node, timer: Timer) -> None:
+    def __init__(self, node, timer: Timer, ack: str = REPLICATION_ACK, mode: str = REPLICATION_MODE) -> None:
+        if ack not in ACK_LEVELS:
+            raise ValueError(f'Unknown replication ack level {ack!r}, expected one of {ACK_LEVELS}')
+        if mode not in REPLICATION_MODES:
+            raise ValueError(f'Unknown replication mode {mode!r}, expected one of {REPLICATION_MODES}')
+
         self.node = node
         self.timer = timer
-        self.storage: Storage = RAMStorage() # Dictionary to store key-value pairs
-
-    def get(self, key: str) -> str:
-        with self.storage.storage_lock:
-            data, error = self.storage.get(key)
-            if error:
-                data = DefaultData()
-            
-            return f'{data.value}{SEPARATOR}{data.version}'
+        self.ack = ack # Successors acknowledging a write before it returns: 'none', 'one', 'quorum' or 'all'
+        self.mode = mode # 'sync' replicates before a write returns, 'async' queues it behind
+        self.storage: Storage = create_storage(node.ip) # Key-value pairs, kept in RAM or in a log on disk
+
+        # Writes made as primary are numbered and logged, so a successor that missed some only gets those
+        self.sequence = 0 # Sequence of the last write
+        self.log: Deque[Tuple[int, str]] = deque(maxlen=REPLICATION_LOG_SIZE) # (sequence, key) of the last writes
+        self.cursors: Dict[int, int] = {} # Successor id -> sequence up to which it has every write
+        self.queues: Dict[int, ReplicationQueue] = {} # Successor id -> its write behind queue
+        self.log_lock = threading.RLock()
+
+        # Hinted handoff: keys of the writes each successor failed to take, sent again once it answers
+        self.hints: Dict[int, Optional[Dict[str, None]]] = {} # Successor id -> keys, None past HINT_LIMIT
+        self.hinted: Dict[int, Tuple[float, ChordNodeReference]] = {} # Successor id -> (time of its first hint, successor)
+        self.hints_lock = threading.Lock()
+
+    # Removed keys read as empty with the version of their removal, so readers comparing replicas see it
+    def get(self, key: str) -> Tuple[str, int]:
+        data = self.storage.get_record(key) or EMPTY_DATA
+        if not data.active:
+            return EMPTY_DATA.text(), data.version
+
+        return data.text(), data.version
         
     def set(self, key: str, data: Data, rep: bool) -> str:
         logging.info(f'Saving key {key}')
-        with self.storage.storage_lock:
-            self.storage.set(key, data)
-
-        with self.node.succ_lock:
-            succ: ChordNodeReference = self.node.successors.get_index(0)
+        self.storage.set(key, data)
 
-        if rep and succ.id != self.node.id:
-            try:
-                self.set_replicate(key, data)
-            except:
-                logging.error(f'Error replicating data with key {key} and value {data.value} from {succ.ip}')
-                return FALSE
+        if not rep:
+            return TRUE
+        if self.mode == 'async':
+            return self.enqueue([key])
+        sequence, _ = self.record([key])
 
-        return TRUE
+        return self.set_replicate(key, data, sequence)
         
-    def set_replicate(self, key: str, data: Data):
+    def set_replicate(self, key: str, data: Data, sequence: int) -> int:
         logging.info(f'Replicating key {key}')
-
-        with self.node.succ_lock:
-            successors: DynamicList[ChordNodeReference] = self.node.successors
-
-            for i in range(len(successors)):
-                try:
-                    succ_i = successors.get_index(i)
-                    logging.info(f'Set replicate key {key} in {succ_i.ip}')
-                    ok = succ_i.store_key(key, data.value, data.version)
-                    if not ok:
-                        logging.error(f'Error replicating key {key} in successor {i}')
-                except:
-                    logging.error(f'Error replicating key {key} in successor {i}')
+        return self.replicate(lambda succ: succ.store_key_async(key, data.value, data.version), [key], sequence, sequence, f'key {key}')
 
     def remove(self, key: str, time: int, rep: bool) -> bool:
-        with self.storage.storage_lock:
-            self.storage.remove(key, time)
+        self.storage.remove(key, time)
 
-        with self.node.succ_lock:
-            succ: ChordNodeReference = self.node.successors.get_index(0)
+        if not rep:
+            return TRUE
+        if self.mode == 'async':
+            return self.enqueue([key])
+        sequence, _ = self.record([key])
 
-        if rep and succ.id != self.node.id:
-            try:
-                self.remove_replicate(key, time)
-            except:
-                logging.error(f'Error removing key {key} from {succ.ip}')
-                return FALSE
-
-        return TRUE
+        return self.remove_replicate(key, time, sequence)
     
-    def remove_replicate(self, key: str, time: int):
+    def remove_replicate(self, key: str, time: int, sequence: int) -> int:
         logging.info(f'Removing key {key}')
+        return self.replicate(lambda succ: succ.delete_key_async(key, time), [key], sequence, sequence, f'removal of key {key}')
+
+    # Send a write to every successor at once, on a copy of the list taken without holding succ_lock
+    # during the round trips. Only the acknowledgements the ack level requires are waited for, the
+    # other successors get the write in the background and the next delta covers any that missed it.
+    # Returns TRUE if enough successors acknowledged. Successors failing the write, even after it
+    # returned, get a hint of the keys.
+    def replicate(self, send: Callable[[ChordNodeReference], Coroutine], keys: List[str], first: int, last: int, what: str) -> int:
+        with self.node.succ_lock:
+            successors: List[ChordNodeReference] = list({succ.id: succ for succ in self.node.successors.list if succ.id != self.node.id}.values())
+
+        async def send_or_hint(succ: ChordNodeReference) -> bool:
+            ok = await send(succ)
+            if ok is not True:
+                # Locks are never taken inside the event loop
+                await asyncio.to_thread(self.hint, succ, keys)
+            return ok
+
+        required = self.required(len(successors))
+        # Level none waits for every successor, as writes did before ack levels, but never fails
+        wait = len(successors) if self.ack == 'none' else required
+        results = run_until([send_or_hint(succ) for succ in successors], wait)
+
+        acks = 0
+        for succ, ok in zip(successors, results):
+            if ok is True:
+                acks += 1
+                self.advance(succ.id, first, last)
+            elif ok is not None:
+                logging.error(f'Error replicating {what} in {succ.ip}')
+
+        if acks < required:
+            logging.error(f'Only {acks} of {required} successors acknowledged {what}')
+            return FALSE
+        return TRUE
 
+    # Write behind: queue the writes for every successor and return once they are queued.
+    # Sequences are given and queued under log_lock so every queue holds them in order.
+    def enqueue(self, keys: List[str]) -> int:
+        queues = self.successor_queues()
+        for queue in queues:
+            queue.wait_room(len(keys))
+
+        with self.log_lock:
+            first, _ = self.record(keys)
+            for queue in queues:
+                queue.put(first, keys)
+        return TRUE
+
+    # Queues of the current successors, the ones of nodes no longer successors are closed
+    def successor_queues(self) -> List[ReplicationQueue]:
+        with self.node.succ_lock:
+            successors: Dict[int, ChordNodeReference] = {succ.id: succ for succ in self.node.successors.list if succ.id != self.node.id}
+
+        with self.log_lock:
+            for id in [id for id in self.queues if id not in successors]:
+                self.queues.pop(id).close()
+            for id, succ in successors.items():
+                if id not in self.queues:
+                    self.queues[id] = ReplicationQueue(self, succ)
+            return list(self.queues.values())
+
+    # Send a batch of queued writes numbered first..last, with the current record of each key
+    def push_writes(self, succ: ChordNodeReference, keys: List[str], first: int, last: int):
+        records: Dict[str, Data] = {}
+        for key in keys:
+            data = self.storage.get_record(key)
+            if data is not None:
+                records[key] = data
+
+        self.push(succ, records)
+        self.advance(succ.id, first, last)
+
+    # Writes a successor is known to miss, None before its first replication
+    def lag(self, id: int) -> int:
+        with self.log_lock:
+            cursor = self.cursors.get(id)
+            return None if cursor is None else self.sequence - cursor
+
+    def queue_stats(self) -> Dict[str, Dict[str, int]]:
+        return {queue.succ.ip: queue.stats() for queue in list(self.queues.values())}
+
+    # Remember keys a successor missed. Past HINT_LIMIT keys they are dropped and the successor is
+    # caught up from the replication log instead.
+    def hint(self, succ: ChordNodeReference, keys: List[str]):
+        with self.hints_lock:
+            if succ.id not in self.hints:
+                self.hints[succ.id] = {}
+                self.hinted[succ.id] = (time.monotonic(), succ)
+            hints = self.hints[succ.id]
+            if hints is None:
+                return
+            hints.update(dict.fromkeys(keys))
+            if len(hints) > HINT_LIMIT:
+                logging.warning(f'More than {HINT_LIMIT} hints for successor {succ.ip}, it will be caught up from the log')
+                self.hints[succ.id] = None
+
+    # Send the hinted writes to the nodes found alive, in batches with the current record of each key.
+    # successors are the ones the check found alive. Hinted nodes no longer in the successor list, the
+    # ones removed after failing a check, are pinged here, so a node back from a short failure gets its
+    # writes before it is a successor again. Hints of nodes not seen for HINT_TTL seconds are dropped
+    # with the cursor of the node, one coming back later gets a full sync.
+    def replay_hints(self, successors: List[ChordNodeReference]):
         with self.node.succ_lock:
-            successors: DynamicList[ChordNodeReference] = self.node.successors
+            current = {succ.id for succ in self.node.successors.list}
+        with self.hints_lock:
+            away = [succ for id, (_, succ) in self.hinted.items() if id not in current]
+        if away:
+            results = run_all([succ.ping_async() for succ in away])
+            successors = successors + [succ for succ, ok in zip(away, results) if ok is True]
+
+        for succ in successors:
+            with self.hints_lock:
+                if succ.id not in self.hints:
+                    continue
+                hints = self.hints.pop(succ.id)
+                self.hinted.pop(succ.id)
+
+            if hints is None:
+                logging.info(f'Catching up {succ.ip} after too many hints')
+                if not self.replicate_all_data(succ):
+                    with self.hints_lock:
+                        self.hints[succ.id] = None
+                        self.hinted[succ.id] = (time.monotonic(), succ)
+                continue
 
-            for i in range(len(successors)):
+            keys = list(hints)
+            logging.info(f'Replaying {len(keys)} hints in {succ.ip}')
+            for i in range(0, len(keys), REPLICATION_BATCH):
+                records: Dict[str, Data] = {}
+                for key in keys[i:i + REPLICATION_BATCH]:
+                    data = self.storage.get_record(key)
+                    if data is not None:
+                        records[key] = data
                 try:
-                    succ_i = successors.get_index(i)
-                    logging.info(f'Remove replicate key {key} from {succ_i.ip}')
-                    ok = succ_i.delete_key(key, time)
-                    if not ok:
-                        logging.error(f'Error removing key {key} in successor {i}')
-                except:
-                    logging.error(f'Error removing key {key} in successor {i}')
+                    self.push(succ, records)
+                except Exception as e:
+                    logging.error(f'Error replaying hints in {succ.ip}: {e}')
+                    self.hint(succ, keys[i:])
+                    break
+
+        now = time.monotonic()
+        with self.hints_lock:
+            expired = [id for id, (since, _) in self.hinted.items() if now - since > HINT_TTL]
+            for id in expired:
+                del self.hints[id]
+                del self.hinted[id]
+        with self.log_lock:
+            for id in expired:
+                if id not in current:
+                    self.cursors.pop(id, None)
+
+    def hint_stats(self) -> Dict[int, int]:
+        with self.hints_lock:
+            return {id: -1 if hints is None else len(hints) for id, hints in self.hints.items()}
+
+    # Successors that must acknowledge a write. With quorum the primary and them are a majority of the copies.
+    def required(self, successors: int) -> int:
+        if self.ack == 'none':
+            return 0
+        if self.ack == 'all':
+            return successors
+        if self.ack == 'quorum':
+            return (successors + 1) // 2
+        return min(1, successors)
+
+    def get_many(self, keys: List[str]) -> Dict[str, List]:
+        values: Dict[str, List] = {}
+        for key in keys:
+            data, error = self.storage.get(key)
+            if error:
+                data = EMPTY_DATA
+            values[key] = [data.text(), data.version]
+
+        return values
+
+    def set_many(self, items: Dict[str, Data], rep: bool) -> int:
+        logging.info(f'Saving {len(items)} keys')
+        self.storage.set_all(items)
+
+        if not rep:
+            return TRUE
+        if self.mode == 'async':
+            return self.enqueue(list(items))
+        first, last = self.record(items)
+
+        return self.replicate(lambda succ: succ.store_many_async(items), list(items), first, last, f'{len(items)} keys')
+
+    def remove_many(self, times: Dict[str, int], rep: bool) -> int:
+        for key, time in times.items():
+            try:
+                self.storage.remove(key, time)
+            except KeyError:
+                logging.error(f'Error removing missing key {key}')
+
+        if not rep:
+            return TRUE
+        if self.mode == 'async':
+            return self.enqueue(list(times))
+        first, last = self.record(times)
+
+        return self.replicate(lambda succ: succ.delete_many_async(times), list(times), first, last, f'removal of {len(times)} keys')
+
+    # Number the writes of the given keys, returns the first and the last sequence
+    def record(self, keys: Iterable[str]) -> Tuple[int, int]:
+        with self.log_lock:
+            first = self.sequence + 1
+            for key in keys:
+                self.sequence += 1
+                self.log.append((self.sequence, key))
+            return first, self.sequence
+
+    # Move the cursor of a successor past the writes first..last it acknowledged. Only if it already had
+    # every write before them, otherwise they are sent again by the next delta.
+    def advance(self, id: int, first: int, last: int):
+        with self.log_lock:
+            cursor = self.cursors.get(id)
+            if cursor is not None and first - 1 <= cursor < last:
+                self.cursors[id] = last
+
+    # Keys written since the cursor of a successor and the sequence they reach.
+    # None when there is no cursor or the log no longer goes back to it.
+    def delta(self, id: int) -> Tuple[Optional[Set[str]], int]:
+        with self.log_lock:
+            cursor = self.cursors.get(id)
+            if cursor is None or cursor > self.sequence or (self.log and self.log[0][0] > cursor + 1):
+                return None, self.sequence
+
+            keys: Set[str] = set()
+            for sequence, key in reversed(self.log):
+                if sequence <= cursor:
+                    break
+                keys.add(key)
+            return keys, self.sequence
+
+    # Successors that failed a check keep their cursor for HINT_TTL seconds, with the hints of the writes
+    # they miss meanwhile. One back in time gets those writes and, once a successor again, only the
+    # writes since its cursor. Their write behind queues are closed, the delta covers what they held.
+    def mark_away(self, nodes: List[ChordNodeReference]):
+        for node in nodes:
+            self.hint(node, [])
+        with self.log_lock:
+            for node in nodes:
+                queue = self.queues.pop(node.id, None)
+                if queue:
+                    queue.close()
+
+    # Purge request of the primary of the keys, replicas drop the tombstones it already dropped
+    def purge(self, versions: Dict[str, int]) -> int:
+        purged = self.storage.purge(versions)
+        logging.info(f'Purged {len(purged)} of {len(versions)} tombstones')
+        return TRUE
+
+    # Tombstone GC task. The primary of a range purges the tombstones older than the grace period
+    # on the node clock, first on every successor holding a replica and only if all of them acknowledge,
+    # on itself. Otherwise they are kept and retried in the next round.
+    def collect_tombstones(self, grace: int = TOMBSTONE_GRACE):
+        try:
+            with self.node.pred_lock:
+                pred: ChordNodeReference = self.node.predecessors.get_index(0)
+            with self.timer.time_lock:
+                now = self.timer.time_counter
+            removed, _ = self.storage.get_remove_range(pred.id, self.node.id)
+
+            expired = {key: data.version for key, data in removed.items() if now - data.version > grace}
+            if not expired:
+                return
+
+            with self.node.succ_lock:
+                successors: List[ChordNodeReference] = [succ for succ in self.node.successors.list if succ.id != self.node.id]
+
+            results = run_all([succ.purge_keys_async(expired) for succ in successors])
+            failed = [succ.ip for succ, ok in zip(successors, results) if ok is not True]
+            if failed:
+                logging.info(f'Keeping {len(expired)} tombstones, not acknowledged by {failed}')
+                return
+
+            purged = self.storage.purge(expired)
+            logging.info(f'Collected {len(purged)} tombstones')
+        except Exception as e:
+            logging.error(f'Error in collect tombstones task: {e}')
 
     def set_partition(self, dict: Dict[str, str], version: Dict[str, int], removed_dict: Dict[str, int]) -> bool:
         new_dict: Dict[str, Data] = {}
@@ -95,44 +368,144 @@ class Replicator:
         for key in dict.keys():
             new_dict[key] = Data(dict[key], version[key])
 
-        with self.storage.storage_lock:
-            try:
-                self.storage.set_all(new_dict)
-                self.storage.remove_all(removed_dict)
-            except:
-                return FALSE
+        try:
+            self.storage.set_all(new_dict)
+            self.storage.remove_all(removed_dict)
+        except:
+            return FALSE
             
         return TRUE
 
-    def replicate_all_data(self, node: ChordNodeReference):
-        with self.node.pred_lock:
-            pred = self.node.predecessors.get_index(0)
+    # Merkle hashes of our records, for the peer comparing its tree with ours
+    def merkle_hashes(self, nodes: List[int]) -> List[int]:
+        return self.storage.merkle.hashes(nodes)
+
+    def merkle_keys(self, buckets: List[int], start: int, end: int) -> Dict[str, List]:
+        records = self.storage.records(buckets, start, end)
+        return {key: [data.version, data.active, record_digest(data)] for key, data in records.items()}
+
+    # Anti-entropy with a peer for the keys with position in (start, end]. The Merkle trees are compared
+    # top down, one level per round trip, descending only into the nodes whose hashes differ. Then the
+    # versions of the keys of the buckets that differ are compared and each side gets the newer records.
+    # Traffic grows with the keys that differ, not with the keys stored. Versions are seconds of the node
+    # clocks, so two writes may share one: then the tombstone wins, else the higher value checksum,
+    # and both sides pick the same record.
+    def sync_range(self, peer: ChordNodeReference, start: int, end: int):
+        tree = self.storage.merkle
+        buckets: List[int] = []
+        level: List[int] = [1]
+        while level:
+            # Nodes partly outside the range hold keys the peer does not have to replicate, only
+            # the ones fully inside are compared and the others are always descended
+            inside = [node for node in level if tree.inside(node, start, end)]
+            theirs = dict(zip(inside, peer.merkle_hashes(inside))) if inside else {}
+            ours = dict(zip(inside, tree.hashes(inside)))
+
+            next_level: List[int] = []
+            for node in level:
+                if node in theirs and theirs[node] == ours[node]:
+                    continue
+                if node >= tree.leaves:
+                    buckets.append(node - tree.leaves)
+                else:
+                    next_level += [child for child in (2 * node, 2 * node + 1) if tree.overlaps(child, start, end)]
+            level = next_level
 
-        if pred.id == self.node.id:
+        if not buckets:
             return
-        
-        logging.info(f'Replicate all data in {node.ip}')
 
-        with self.storage.storage_lock:
-            dict, _ = self.storage.get_all()
-            removed_dict, _ = self.storage.get_remove_all()
+        ours_records = self.storage.records(buckets, start, end)
+        theirs_versions = peer.merkle_keys(buckets, start, end)
+
+        push: Dict[str, Data] = {}
+        pull: List[str] = []
+
+        for key in ours_records.keys() | theirs_versions.keys():
+            data = ours_records.get(key)
+            ours = [data.version, data.active, record_digest(data)] if data else None
+            theirs = theirs_versions.get(key)
+            if ours == theirs:
+                continue
+
+            if theirs is None or (ours is not None and (ours[0], not ours[1], ours[2]) > (theirs[0], not theirs[1], theirs[2])):
+                push[key] = data
+            elif theirs[1]:
+                pull.append(key)
+            else:
+                self.storage.merge(key, Data('', theirs[0], False))
+
+        if pull:
+            for key, data in peer.retrieve_many(pull).items():
+                if data.version:
+                    self.storage.merge(key, data)
+
+        self.push(peer, push)
+
+        logging.info(f'Synced with {peer.ip}: {len(buckets)} buckets differ, sent {len(push)} keys, received {len(pull)}')
+
+    # Send records to a peer, it keeps the newer version of each key and we keep the ones it had newer
+    def push(self, peer: ChordNodeReference, records: Dict[str, Data]):
+        if not records:
+            return
 
         new_dict: Dict[str, str] = {}
         new_version: Dict[str, int] = {}
         new_removed_dict: Dict[str, int] = {}
 
-        for key, data in dict.items():
-            if inbetween(getShaRepr(key), pred.id, self.node.id):
-                new_dict[key] = data.value
+        for key, data in records.items():
+            if data.active:
+                new_dict[key] = data.text()
                 new_version[key] = data.version
-
-        for key, data in removed_dict.items():
-            if inbetween(getShaRepr(key), pred.id, self.node.id):
+            else:
                 new_removed_dict[key] = data.version
 
-        ok = node.set_partition(code_dict(new_dict), code_dict(new_version), code_dict(new_removed_dict))
+        response, ok = peer.resolve_data(new_dict, new_version, new_removed_dict)
         if not ok:
-            logging.error(f'Error replicating all data')
+            raise ConnectionError(f'Error sending {len(records)} keys to {peer.ip}')
+
+        res_dict: Dict[str, str] = response[0]
+        res_version: Dict[str, int] = response[1]
+        res_removed_dict: Dict[str, int] = response[2]
+
+        for key, value in res_dict.items():
+            self.storage.merge(key, Data(value, res_version[key]))
+        for key, time in res_removed_dict.items():
+            self.storage.merge(key, Data('', time, False))
+
+    # Returns False if the successor could not be brought up to date
+    def replicate_all_data(self, node: ChordNodeReference) -> bool:
+        with self.node.pred_lock:
+            pred = self.node.predecessors.get_index(0)
+
+        if pred.id == self.node.id:
+            return True
+        
+        # Only the keys this node is responsible for. A successor with a cursor still in the log gets
+        # the keys written since, any other is compared in full. So does one with an empty tree, which
+        # restarted without its storage after its cursor was taken.
+        keys, sequence = self.delta(node.id)
+        try:
+            if keys is not None and len(self.storage.index) and node.merkle_hashes([1]) == [0]:
+                keys = None
+            if keys is None:
+                logging.info(f'Replicate all data in {node.ip}')
+                self.sync_range(node, pred.id, self.node.id)
+            else:
+                records: Dict[str, Data] = {}
+                for key in keys:
+                    data = self.storage.get_record(key)
+                    if data is not None and inbetween(data.position, pred.id, self.node.id):
+                        records[key] = data
+                logging.info(f'Replicate {len(records)} keys written since the last replication in {node.ip}')
+                self.push(node, records)
+        except Exception as e:
+            logging.error(f'Error replicating all data: {e}')
+            return False
+
+        with self.log_lock:
+            if self.cursors.get(node.id, -1) < sequence:
+                self.cursors[node.id] = sequence
+        return True
 
     def fail_predecessor_storage(self):
         with self.node.pred_lock:
@@ -143,84 +516,44 @@ class Replicator:
         
         logging.info('Absorbe all predecessor data')
 
-        with self.storage.storage_lock:
-            dict, _ = self.storage.get_all()
-            removed_dict, _ = self.storage.get_remove_all()
-
-        new_dict: Dict[str, str] = {}
-        new_version: Dict[str, int] = {}
-        new_removed_dict: Dict[str, int] = {}
-
-        for key, data in dict.items():
-            if inbetween(getShaRepr(key), pred.id, self.node.id):
-                continue
-
-            new_dict[key] = data.value
-            new_version[key] = data.version
-
-        for key, data in removed_dict.items():
-            if inbetween(getShaRepr(key), pred.id, self.node.id):
-                continue
-            
-            new_removed_dict[key] = data.version
-
         with self.node.succ_lock:
-            for i in range(len(self.node.successors)):
-                succ: ChordNodeReference = self.node.successors.get_index(i)
-                if succ.id == self.node.id:
-                    continue
-                ok = succ.set_partition(code_dict(new_dict), code_dict(new_version), code_dict(new_removed_dict))
-                if not ok:
-                    logging.error(f'Error replicating in {succ.ip}')
+            successors: List[ChordNodeReference] = [succ for succ in self.node.successors.list if succ.id != self.node.id]
 
-    def resolve_data(self, dict: Dict[str, str], version: Dict[str, int], removed_dict: Dict[str, int]) -> str:
+        # Every key outside (pred, node], the replicas this node kept for the failed predecessors
+        for succ in successors:
+            try:
+                self.sync_range(succ, self.node.id, pred.id)
+            except Exception as e:
+                logging.error(f'Error replicating in {succ.ip}: {e}')
+
+    # Merge the partition of the node that became our successor. Every key is merged on its own,
+    # so reads of other keys never wait for the whole partition. The newer version of each key wins,
+    # ours are sent back.
+    def resolve_data(self, dict: Dict[str, str], version: Dict[str, int], removed_dict: Dict[str, int]) -> List[Dict]:
         logging.info('Resolving data versions')
 
-        new_dict: Dict[str, Data] = {}
         res_dict_value: Dict[str, str] = {}
         res_dict_version: Dict[str, int] = {}
         res_removed_dict: Dict[str, int] = {}
 
-        with self.storage.storage_lock:
-            actual_dict, error = self.storage.get_all()
-            if not error:
-                return ''
-            
-            for key, value in dict.items():
-                try:
-                    data = actual_dict[key]
-                except:
-                    data = DefaultData()
-
-                if data.version > version[key]:
-                    res_dict_value[key] = data.value
-                    res_dict_version[key] = data.version
-                else:
-                    new_dict[key] = Data(value, version[key])
-
-            for key, time in removed_dict.items():
-                try:
-                    data = actual_dict[key]
-                except:
-                    data = DefaultData()
-
-                if data.version > time:
-                    res_dict_value[key] = data.value
-                    res_dict_version[key] = data.version
-                else:
-                    self.storage.remove(key, time)
-
-            remove, _ = self.storage.get_remove_all()
-
-            for key, data in remove.items():
-                time = version[key]
+        for key, value in dict.items():
+            current = self.storage.merge(key, Data(value, version[key]))
+            if current is None:
+                continue
 
-                if data.version > time:
-                    res_removed_dict[key] = data.version
+            if current.active:
+                res_dict_value[key] = current.text()
+                res_dict_version[key] = current.version
+            else:
+                res_removed_dict[key] = current.version
 
-            self.storage.set_all(new_dict)
+        for key, time in removed_dict.items():
+            current = self.storage.merge(key, Data('', time, False))
+            if current is not None and current.active:
+                res_dict_value[key] = current.text()
+                res_dict_version[key] = current.version
 
-            return f'{code_dict(res_dict_value)}{SEPARATOR}{code_dict(res_dict_version)}{SEPARATOR}{code_dict(res_removed_dict)}'
+        return [res_dict_value, res_dict_version, res_removed_dict]
 
     def new_predecessor_storage(self):
         with self.node.succ_lock:
@@ -236,79 +569,40 @@ class Replicator:
         
         logging.info('Delegate predecessor data')
 
-        with self.storage.storage_lock:
-            dict, _ = self.storage.get_all()
-            remove, _ = self.storage.get_remove_all()
-
-        new_dict: Dict[str, str] = {}
-        new_version: Dict[str, int] = {}
-        new_removed_dict: Dict[str, int] = {}
-
-        for key, data in dict.items():
-            if not inbetween(getShaRepr(key), pred_pred.id, pred.id):
-                continue
-
-            new_dict[key] = data.value
-            new_version[key] = data.version
-
-        for key, data in remove.items():
-            if not inbetween(getShaRepr(key), pred_pred.id, pred.id):
-                continue
-
-            new_removed_dict[key] = data.version
-
-        response, ok = pred.resolve_data(code_dict(new_dict), code_dict(new_version), code_dict(new_removed_dict))
-        if not ok:
-            logging.error(f'Error resolving data in {pred.ip}')
-            return
-        
-        res_dict: Dict[str, str] = decode_dict(response[0])
-        res_version: Dict[str, int] = decode_dict(response[1])
-        res_removed_dict: Dict[str, int] = decode_dict(response[2])
-
-        new_res_dict: Dict[str, Data] = {}
-
-        for key, value in res_dict.items():
-            new_res_dict[key] = Data(value, res_version[key])
-        
-        with self.storage.storage_lock:
-            self.storage.set_all(new_res_dict)
-            self.storage.remove_all(res_removed_dict)
+        # The keys the new predecessor is now responsible for
+        try:
+            self.sync_range(pred, pred_pred.id, pred.id)
+        except Exception as e:
+            logging.error(f'Error resolving data in {pred.ip}: {e}')
 
     def fix_storage(self):
-        while True:
-            try:
-                logging.info('Fixing storage')
+        try:
+            logging.info('Fixing storage')
 
-                with self.storage.storage_lock:
-                    dict, _ = self.storage.get_all()
-                    logging.info(f'Data storage len: {len(dict)}')
+            logging.info(f'Data storage len: {len(self.storage.index)}')
 
-                with self.node.succ_lock:
-                    succ_len = len(self.node.successors)
+            with self.node.succ_lock:
+                succ_len = len(self.node.successors)
 
-                with self.node.pred_lock:
-                    while len(self.node.predecessors) > succ_len:
-                        self.node.predecessors.remove_index(len(self.node.predecessors) - 1)
-                        if len(self.node.predecessors) == 0:
-                            self.node.predecessors.set_index(0, self.node.ref)
-                            break
+            with self.node.pred_lock:
+                while len(self.node.predecessors) > succ_len:
+                    self.node.predecessors.remove_index(len(self.node.predecessors) - 1)
+                    if len(self.node.predecessors) == 0:
+                        self.node.predecessors.set_index(0, self.node.ref)
+                        break
 
-                with self.node.pred_lock:
-                    pred: ChordNodeReference = self.node.predecessors.get_index(len(self.node.predecessors) - 1)
+            with self.node.pred_lock:
+                pred: ChordNodeReference = self.node.predecessors.get_index(len(self.node.predecessors) - 1)
 
-                if pred.id != self.node.id:
-                    pred_pred = pred.pred
-
-                    if pred_pred.id != self.node.id and pred_pred.id != pred.id:
-                        with self.timer.time_lock:
-                            time_c = self.timer.time_counter
-                        for key in dict.keys():
-                            if inbetween(getShaRepr(key), pred_pred.id, self.node.id):
-                                continue
+            if pred.id != self.node.id:
+                pred_pred = pred.pred
 
+                if pred_pred.id != self.node.id and pred_pred.id != pred.id:
+                    with self.timer.time_lock:
+                        time_c = self.timer.time_counter
+                    # Keys outside (pred_pred, node] are no longer replicated here
+                    for key, data in self.storage.snapshot().range(self.node.id, pred_pred.id):
+                        if data.active:
                             self.storage.remove(key, time_c, False)
-            except Exception as e:
-                logging.error(f'Error in fix storage thread: {e}')
-
-            time.sleep(60)
\ No newline at end of file
+        except Exception as e:
+            logging.error(f'Error in fix storage task: {e}')
@@ -0,0 +1,64 @@
+import bisect
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from chord.node_reference import ChordNodeReference
+from chord.utils import inbetween
+from config import ROUTING_CACHE_SIZE
+
+# Remembers which node is responsible for each ring range seen in a lookup, so repeated keys are routed
+# without hops. Ranges are (start, node.id] and the least recently used ones are evicted first.
+class RoutingCache:
+    def __init__(self, capacity: int = ROUTING_CACHE_SIZE) -> None:
+        self.capacity = capacity
+        self.ranges: OrderedDict[int, Tuple[int, ChordNodeReference]] = OrderedDict() # node id -> (start, node)
+        self.ends: List[int] = [] # Sorted node ids of the cached ranges
+        self.cache_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key_hash: int) -> Optional[ChordNodeReference]:
+        with self.cache_lock:
+            if self.ends:
+                # The only range that may hold key_hash is the one ending at the first node id after it
+                end = self.ends[bisect.bisect_left(self.ends, key_hash) % len(self.ends)]
+                start, node = self.ranges[end]
+                if inbetween(key_hash, start, end):
+                    self.ranges.move_to_end(end)
+                    self.hits += 1
+                    return node
+
+            self.misses += 1
+            return None
+
+    def add(self, start: int, node: ChordNodeReference):
+        with self.cache_lock:
+            if node.id not in self.ranges:
+                bisect.insort(self.ends, node.id)
+            self.ranges[node.id] = (start, node)
+            self.ranges.move_to_end(node.id)
+
+            while len(self.ranges) > self.capacity:
+                end, _ = self.ranges.popitem(last=False)
+                self._remove_end(end)
+
+    def invalidate(self, node_id: int):
+        with self.cache_lock:
+            if self.ranges.pop(node_id, None):
+                self._remove_end(node_id)
+
+    def clear(self):
+        with self.cache_lock:
+            self.ranges.clear()
+            self.ends = []
+
+    def _remove_end(self, end: int):
+        index = bisect.bisect_left(self.ends, end)
+        if index < len(self.ends) and self.ends[index] == end:
+            del self.ends[index]
+
+    def stats(self) -> Dict[str, int]:
+        with self.cache_lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.ranges)}
@@ -1,14 +1,42 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
 import threading
-from typing import Dict, Tuple
+import time
+import zlib
+from typing import Dict, Iterator, List, Tuple
 
+from chord.merkle import MerkleTree
+from chord.protocol import COUNT, EncodedStr, decode_fields, encode_fields
+from chord.utils import getShaRepr, inbetween
+from config import STORAGE_CHUNK_SIZE, STORAGE_INDEX_FANOUT, STORAGE_COMPACT_MIN_SIZE, STORAGE_COMPACT_RATIO, STORAGE_ENGINE, STORAGE_FSYNC_INTERVAL, STORAGE_LOCK_STRIPES, STORAGE_PATH
+
+# Slotted so each stored record carries no per instance __dict__
 class Data:
-    def __init__(self, value: str, version: int, active: bool = True) -> None:
+    __slots__ = ('value', 'version', 'active', 'position')
+
+    def __init__(self, value: str, version: int, active: bool = True, position: int = None) -> None:
         self.value = value
         self.version = version
         self.active = active
+        self.position = position # Ring position of the key, set by the storage on write
 
     def is_empty(self) -> bool:
         return self.value == ''
+
+    # Value as sent to other nodes
+    def text(self) -> str:
+        return self.value
+
+    # Checksum of the value, tells apart records of a key written in the same second of two clocks
+    def digest(self) -> int:
+        return zlib.crc32(self.value.encode('utf-8'))
+
+    # Stored records are never modified, a change publishes a new copy
+    def copy(self, version: int, active: bool) -> 'Data':
+        return Data(self.value, version, active, self.position)
     
     def __str__(self) -> str:
         return f'{self.value},{self.version},{self.active}'
@@ -16,61 +44,344 @@ class Data:
     def __repr__(self) -> str:
         return f'Data(value={self.value}, version={self.version}, active={self.active})'
     
+# Empty value returned for missing keys, shared by every read so it must never change
 class DefaultData(Data):
+    __slots__ = ()
+
     def __init__(self) -> None:
-        super().__init__('', 0)
+        for name, value in (('value', ''), ('version', 0), ('active', True), ('position', None)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DefaultData is immutable')
+
+EMPTY_DATA = DefaultData()
+
+# Locks for the keys of the storage, keys hashing to the same stripe share one.
+# Writers of different keys rarely wait on each other and readers never take them.
+class StripedLock:
+    def __init__(self, stripes: int = STORAGE_LOCK_STRIPES) -> None:
+        self.locks = [threading.RLock() for _ in range(stripes)]
+
+    def __call__(self, key: str) -> threading.RLock:
+        return self.locks[hash(key) % len(self.locks)]
+
+# Immutable run of keys of the ring sorted by position, with their records
+class Chunk:
+    __slots__ = ('positions', 'keys', 'records')
+
+    def __init__(self, positions: tuple, keys: tuple, records: tuple) -> None:
+        self.positions = positions
+        self.keys = keys
+        self.records = records
+
+    # Index of key in the chunk, or where it goes, and whether it is there.
+    # Positions of different keys may collide, those keys sit next to each other.
+    def find(self, position: int, key: str) -> Tuple[int, bool]:
+        i = bisect.bisect_left(self.positions, position)
+        while i < len(self.positions) and self.positions[i] == position:
+            if self.keys[i] == key:
+                return i, True
+            i += 1
+        return i, False
+
+    # Copy of the chunk with the record of key replaced or inserted
+    def put(self, position: int, key: str, record: Data) -> 'Chunk':
+        i, found = self.find(position, key)
+        if found:
+            return Chunk(self.positions, self.keys, self.records[:i] + (record,) + self.records[i + 1:])
+        return Chunk(self.positions[:i] + (position,) + self.positions[i:], self.keys[:i] + (key,) + self.keys[i:], self.records[:i] + (record,) + self.records[i:])
+
+    # Copy of the chunk without key, the same chunk if it is not there
+    def delete(self, position: int, key: str) -> 'Chunk':
+        i, found = self.find(position, key)
+        if not found:
+            return self
+        return Chunk(self.positions[:i] + self.positions[i + 1:], self.keys[:i] + self.keys[i + 1:], self.records[:i] + self.records[i + 1:])
+
+    # Halves of the chunk, keys with the same position stay together
+    def split(self) -> Tuple['Chunk', 'Chunk']:
+        middle = len(self.positions) // 2
+        while 0 < middle < len(self.positions) and self.positions[middle] == self.positions[middle - 1]:
+            middle += 1
+        left = Chunk(self.positions[:middle], self.keys[:middle], self.records[:middle])
+        right = Chunk(self.positions[middle:], self.keys[middle:], self.records[middle:])
+        return left, right
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+# Immutable inner node of the index. Child i holds the positions from bounds[i] up to bounds[i + 1],
+# the first one also every position below. Children are chunks at the lowest level, branches above.
+class Branch:
+    __slots__ = ('bounds', 'children', 'size')
+
+    def __init__(self, bounds: tuple = (), children: tuple = (), size: int = 0) -> None:
+        self.bounds = bounds
+        self.children = children
+        self.size = size
+
+    # Index of the child holding position
+    def child(self, position: int) -> int:
+        return max(bisect.bisect_right(self.bounds, position) - 1, 0)
+
+    # Chunks that may hold positions above low, in ring order
+    def chunks(self, low: int = -1) -> Iterator[Chunk]:
+        stack = [iter(self.children[self.child(low):])]
+        while stack:
+            for child in stack[-1]:
+                if isinstance(child, Chunk):
+                    yield child
+                else:
+                    stack.append(iter(child.children[child.child(low):]))
+                    break
+            else:
+                stack.pop()
+
+    # Halves of the branch
+    def split(self) -> Tuple['Branch', 'Branch']:
+        middle = len(self.children) // 2
+        left, right = self.children[:middle], self.children[middle:]
+        return Branch(self.bounds[:middle], left, sum(len(child) for child in left)), Branch(self.bounds[middle:], right, sum(len(child) for child in right))
+
+    def __len__(self) -> int:
+        return self.size
+
+# Point in time view of the storage. Nothing in it ever changes, so it is read without locks.
+class Snapshot:
+    __slots__ = ('tree',)
+
+    def __init__(self, tree: Branch = Branch()) -> None:
+        self.tree = tree
+
+    # Records with position in (low, high], no high bound when it is None
+    def scan(self, low: int, high: int = None) -> Iterator[Tuple[str, Data]]:
+        for chunk in self.tree.chunks(low):
+            for i in range(bisect.bisect_right(chunk.positions, low), len(chunk)):
+                if high is not None and chunk.positions[i] > high:
+                    return
+                yield chunk.keys[i], chunk.records[i]
+
+    # Records with key position in (start, end], the arc wraps around 0 when start >= end
+    def range(self, start: int, end: int) -> Iterator[Tuple[str, Data]]:
+        if start < end:
+            yield from self.scan(start, end)
+        else: # start == end is the whole ring
+            yield from self.scan(start)
+            yield from self.scan(-1, end)
+
+    def items(self) -> Iterator[Tuple[str, Data]]:
+        for chunk in self.tree.chunks():
+            yield from zip(chunk.keys, chunk.records)
+
+    def __len__(self) -> int:
+        return self.tree.size
+
+# Records sorted by ring position in a persistent tree of chunks of up to chunk_size keys, under
+# branches of up to fanout children. A write copies the chunk of its key and the branches above it,
+# then publishes them as a new snapshot. Taking a snapshot is reading the current one, no matter how
+# many keys are stored.
+class RingMap:
+    def __init__(self, chunk_size: int = STORAGE_CHUNK_SIZE, fanout: int = STORAGE_INDEX_FANOUT) -> None:
+        self.chunk_size = chunk_size
+        self.fanout = max(fanout, 2)
+        self.root = Snapshot()
+        self.index_lock = threading.Lock() # Publication of a new root
+
+    def snapshot(self) -> Snapshot:
+        return self.root
+
+    def put(self, position: int, key: str, record: Data):
+        with self.index_lock:
+            tree = self.root.tree
+            if not tree.children:
+                self.root = Snapshot(Branch((position,), (Chunk((position,), (key,), (record,)),), 1))
+                return
+
+            parts = self.put_node(tree, position, key, record)
+            if len(parts) == 1:
+                self.root = Snapshot(parts[0])
+            else: # The root split, the tree grows one level
+                left, right = parts
+                self.root = Snapshot(Branch((left.bounds[0], right.bounds[0]), parts, len(left) + len(right)))
+
+    # Copies of node with the record put, two of them when it had to split
+    def put_node(self, node: Branch, position: int, key: str, record: Data) -> tuple:
+        c = node.child(position)
+        child = node.children[c]
+        if isinstance(child, Chunk):
+            chunk = child.put(position, key, record)
+            left, right = chunk.split() if len(chunk) > self.chunk_size else (chunk, None)
+            # Small enough, or every key at one position
+            parts, bounds = ((chunk,), ()) if not right else ((left, right), (right.positions[0],))
+        else:
+            parts = self.put_node(child, position, key, record)
+            bounds = tuple(part.bounds[0] for part in parts[1:])
+
+        size = node.size + sum(len(part) for part in parts) - len(child)
+        branch = Branch(node.bounds[:c + 1] + bounds + node.bounds[c + 1:], node.children[:c] + parts + node.children[c + 1:], size)
+        return branch.split() if len(branch.children) > self.fanout else (branch,)
+
+    def delete(self, position: int, key: str):
+        with self.index_lock:
+            tree = self.root.tree
+            if not tree.children:
+                return
+
+            node = self.delete_node(tree, position, key)
+            if node is tree:
+                return
+            while len(node.children) == 1 and isinstance(node.children[0], Branch):
+                node = node.children[0]
+            self.root = Snapshot(node)
+
+    # Copy of node without the record, the same node if it is not there
+    def delete_node(self, node: Branch, position: int, key: str) -> Branch:
+        c = node.child(position)
+        child = node.children[c]
+        updated = child.delete(position, key) if isinstance(child, Chunk) else self.delete_node(child, position, key)
+        if updated is child:
+            return node
+        if len(updated):
+            return Branch(node.bounds, node.children[:c] + (updated,) + node.children[c + 1:], node.size - 1)
+        return Branch(node.bounds[:c] + node.bounds[c + 1:], node.children[:c] + node.children[c + 1:], node.size - 1)
+
+    # Replace the whole map with the given records, for bulk loads with writers stopped
+    def build(self, records: Dict[str, Data]):
+        entries = sorted(((data.position, key, data) for key, data in records.items()), key=lambda entry: (entry[0], entry[1]))
+        level: List = []
+        half = max(self.chunk_size // 2, 1) # Leave room to grow before the first splits
+        start = 0
+        while start < len(entries):
+            end = min(start + half, len(entries))
+            while 0 < end < len(entries) and entries[end][0] == entries[end - 1][0]:
+                end += 1
+            positions, keys, datas = zip(*entries[start:end])
+            level.append(Chunk(positions, keys, datas))
+            start = end
+
+        bounds = [chunk.positions[0] for chunk in level]
+        while len(level) > self.fanout:
+            branches = []
+            for start in range(0, len(level), self.fanout):
+                children = tuple(level[start:start + self.fanout])
+                branches.append(Branch(tuple(bounds[start:start + self.fanout]), children, sum(len(child) for child in children)))
+            level, bounds = branches, [branch.bounds[0] for branch in branches]
+        with self.index_lock:
+            self.root = Snapshot(Branch(tuple(bounds), tuple(level), len(entries)))
+
+    def __len__(self) -> int:
+        return self.root.tree.size
 
 class Storage:
     def __init__(self) -> None:
-        self.storage_lock = threading.RLock()
+        self.locks = StripedLock() # Lock of each key, for writes only
         self.storage = None
         
     def get(self, key: str) -> Tuple[Data, bool]:
         pass
 
+    def get_record(self, key: str) -> Data:
+        pass
+
     def get_all(self) -> Tuple[Dict[str, Data], bool]:
         pass
 
     def get_remove_all(self) -> Tuple[Dict[str, Data], bool]:
         pass
 
+    def get_range(self, start: int, end: int) -> Tuple[Dict[str, Data], bool]:
+        pass
+
+    def get_remove_range(self, start: int, end: int) -> Tuple[Dict[str, Data], bool]:
+        pass
+
+    def snapshot(self) -> Snapshot:
+        pass
+
     def set(self, key: str, value: Data) -> bool:
         pass
 
     def set_all(self, dict: Dict[str, Data]) -> bool:
         pass
 
+    def merge(self, key: str, data: Data) -> Data:
+        pass
+
     def remove(self, key, time, rep: bool = True) -> bool:
         pass
 
     def remove_all(self, dict: Dict[str, int]) -> bool:
         pass
 
+    def purge(self, dict: Dict[str, int]) -> List[str]:
+        pass
+
+    def records(self, buckets: List[int], start: int, end: int) -> Dict[str, Data]:
+        pass
+
+# Records are copy on write: a stored Data is never modified, every change replaces it under the
+# lock of its key. Reads need no lock and scans iterate a snapshot of the ring map, writers go on meanwhile.
 class RAMStorage(Storage):
     def __init__(self) -> None:
         super().__init__()
-        self.storage: Dict[str, Data] = {}
+        self.storage: Dict[str, Data] = {} # Latest record of each key, for reads by key
+        self.index = RingMap() # The same records by ring position, for snapshots
+        self.merkle = MerkleTree() # Hashes of the records by ring position, for anti-entropy
 
+    # Removed keys read as missing
     def get(self, key) -> Tuple[Data, bool]:
-        data = self.storage.get(key, DefaultData())
+        data = self.storage.get(key, EMPTY_DATA)
+        if not data.active:
+            data = EMPTY_DATA
         return data, data.is_empty()
+
+    # Stored record of a key, removed ones included, None if missing
+    def get_record(self, key: str) -> Data:
+        return self.storage.get(key)
+
+    # Publish the record of a key, called holding the lock of the key
+    def write(self, key: str, data: Data):
+        if data.position is None:
+            data.position = getShaRepr(key)
+        self.merkle.update(data.position, key, self.storage.get(key), data)
+        self.index.put(data.position, key, data)
+        self.storage[key] = data
+
+    # Forget a key, called holding the lock of the key
+    def drop(self, key: str, data: Data):
+        self.merkle.update(data.position, key, self.storage[key], None)
+        self.index.delete(data.position, key)
+        del self.storage[key]
     
     def set(self, key: str, data: Data) -> bool:
         data.active = True
-        self.storage[key] = data
+        with self.locks(key):
+            self.write(key, data)
         return True
     
     def remove(self, key: str, time: int, rep: bool = True) -> bool:
-        data = self.storage[key]
-        if rep:
-            data.active = False
-        data.version = time
-        self.storage[key] = data
+        with self.locks(key):
+            data = self.storage[key]
+            self.write(key, data.copy(time, False if rep else data.active))
         return True
+
+    # Store data unless the key holds a newer version, which is returned instead
+    def merge(self, key: str, data: Data) -> Data:
+        with self.locks(key):
+            current = self.storage.get(key)
+            if current and current.version > data.version:
+                return current
+            self.write(key, data)
+        return None
+
+    # Point in time view for scans, it takes no copy and writers go on while it is used
+    def snapshot(self) -> Snapshot:
+        return self.index.snapshot()
     
     def get_all(self) -> Tuple[Dict[str, Data], bool]:
         new_storage: Dict[str, Data] = {}
-        for key, data in self.storage.items():
+        for key, data in self.snapshot().items():
             if data.active:
                 new_storage[key] = data
 
@@ -78,24 +389,316 @@ class RAMStorage(Storage):
     
     def get_remove_all(self) -> Tuple[Dict[str, Data], bool]:
         new_storage: Dict[str, Data] = {}
-        for key, data in self.storage.items():
+        for key, data in self.snapshot().items():
             if not data.active:
                 new_storage[key] = data
 
         return new_storage, True
     
+    # Active data with key position in (start, end]
+    def get_range(self, start: int, end: int) -> Tuple[Dict[str, Data], bool]:
+        new_storage: Dict[str, Data] = {}
+        for key, data in self.snapshot().range(start, end):
+            if data.active:
+                new_storage[key] = data
+
+        return new_storage, True
+
+    # Removed data with key position in (start, end]
+    def get_remove_range(self, start: int, end: int) -> Tuple[Dict[str, Data], bool]:
+        new_storage: Dict[str, Data] = {}
+        for key, data in self.snapshot().range(start, end):
+            if not data.active:
+                new_storage[key] = data
+
+        return new_storage, True
+
     def set_all(self, dict: Dict[str, Data]) -> bool:
         for key, data in dict.items():
             data.active = True
-            self.storage[key] = data
+            with self.locks(key):
+                self.write(key, data)
 
         return True
     
+    # Keys never seen here still get their tombstone
     def remove_all(self, dict: Dict[str, int]) -> bool:
         for key, version in dict.items():
-            data = self.storage[key]
-            data.active = False
-            data.version = version
-            self.storage[key] = data
+            with self.locks(key):
+                self.write(key, self.storage.get(key, EMPTY_DATA).copy(version, False))
+
+        return True
+
+    # Forget keys for good, unless they were written again after the given version. Returns the purged keys.
+    def purge(self, dict: Dict[str, int]) -> List[str]:
+        purged: List[str] = []
+        for key, version in dict.items():
+            with self.locks(key):
+                data = self.storage.get(key)
+                if data is None or (data.active and data.version > version):
+                    continue
+                self.drop(key, data)
+            purged.append(key)
+
+        return purged
+
+    # Records of the Merkle buckets given with key position in (start, end]
+    def records(self, buckets: List[int], start: int, end: int) -> Dict[str, Data]:
+        snapshot = self.snapshot()
+        records: Dict[str, Data] = {}
+        for bucket in buckets:
+            low, high = self.merkle.span(self.merkle.leaves + bucket)
+            for key, data in snapshot.scan(low, high):
+                if inbetween(data.position, start, end):
+                    records[key] = data
+
+        return records
+
+# Log record header: payload length | crc32 of the payload.
+# The payload holds the fields key and value (str), version (int) and active (bool, None for a purged key).
+RECORD = struct.Struct('!II')
+STR_HEADER = 1 + COUNT.size # Type tag and length before the bytes of a str field
+
+# Read only memory map of a log file, mapped again once the file grows past it.
+# Views handed out keep their map alive, so a replaced map is never closed under a reader.
+class Segment:
+    def __init__(self, path: str) -> None:
+        self.file = open(path, 'rb')
+        self.map: mmap.mmap = None
+        self.map_lock = threading.Lock()
+
+    def view(self, offset: int, length: int) -> memoryview:
+        if length == 0:
+            return memoryview(b'')
+
+        map = self.map
+        if map is None or offset + length > len(map):
+            with self.map_lock:
+                if self.map is None or offset + length > len(self.map):
+                    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                map = self.map
+        return memoryview(map)[offset:offset + length]
+
+    # Map the whole file before closing it, so records read after the swap still get their views
+    def close(self):
+        with self.map_lock:
+            size = os.fstat(self.file.fileno()).st_size
+            if size and (self.map is None or len(self.map) < size):
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file.close()
+
+# Value stored in a log segment. Reads get a memoryview of the mapped file and it is only decoded
+# when the value is needed as a str, so the page cache is the only copy of the value.
+class LogData(Data):
+    __slots__ = ('segment', 'offset', 'length', 'crc')
+
+    def __init__(self, segment: Segment, offset: int, length: int, version: int, active: bool = True, position: int = None, crc: int = 0) -> None:
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.version = version
+        self.active = active
+        self.position = position
+        self.crc = crc # Checksum of the value, taken while it was in memory
+
+    @property
+    def raw(self) -> memoryview:
+        return self.segment.view(self.offset, self.length)
+
+    @property
+    def value(self) -> str:
+        return str(self.raw, 'utf-8')
+
+    def is_empty(self) -> bool:
+        return self.length == 0
+
+    def text(self) -> EncodedStr:
+        return EncodedStr(self.raw)
+
+    def digest(self) -> int:
+        return self.crc
+
+    def copy(self, version: int, active: bool) -> 'LogData':
+        return LogData(self.segment, self.offset, self.length, version, active, self.position, self.crc)
+
+# Storage that appends every change to a log on disk and replays it when the node starts again.
+# Keys, versions and ring positions stay in memory, values are read from the mapped log.
+# The log is fsynced in batches every fsync_interval seconds, and rewritten with only the
+# live records once it holds compact_ratio times more records than keys.
+class LogStorage(RAMStorage):
+    def __init__(self, path: str, fsync_interval: float = STORAGE_FSYNC_INTERVAL, compact_ratio: int = STORAGE_COMPACT_RATIO, compact_min_size: int = STORAGE_COMPACT_MIN_SIZE) -> None:
+        super().__init__()
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.log_lock = threading.RLock() # Appends, fsync and compaction
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        open(self.path, 'ab').close()
+        self.segment = Segment(self.path)
+        self.log_records = 0 # Records in the log, live or not
+        self.replay()
+        self.log = open(self.path, 'ab') # Opened after replay, which may cut the log
+        self.size = self.log.tell()
+        self.dirty = False
+        self.closed = False
+
+        threading.Thread(target=self.sync, daemon=True).start() # Start fsync and compaction thread
+
+    # Load every record of the log through the map, a torn record at the end is cut off
+    def replay(self):
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return
+
+        start = time.monotonic()
+        view = self.segment.view(0, size)
+        offset = 0
+        while offset + RECORD.size <= size:
+            length, crc = RECORD.unpack_from(view, offset)
+            payload = view[offset + RECORD.size:offset + RECORD.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+
+            (key_length,) = COUNT.unpack_from(payload, 1)
+            key = str(payload[STR_HEADER:STR_HEADER + key_length], 'utf-8')
+            value_start = STR_HEADER + key_length + STR_HEADER
+            (value_length,) = COUNT.unpack_from(payload, value_start - COUNT.size)
+            version, active = decode_fields(payload, value_start + value_length)
+
+            if active is None:
+                self.unload(key)
+            else:
+                value = payload[value_start:value_start + value_length]
+                self.load(key, LogData(self.segment, offset + RECORD.size + value_start, value_length, version, active, crc=zlib.crc32(value)))
+            self.log_records += 1
+            offset += RECORD.size + length
+
+        if offset < size:
+            logging.warning(f'Discarding {size - offset} bytes of broken records at the end of {self.path}')
+            with open(self.path, 'r+b') as file:
+                file.truncate(offset)
+            self.segment.map = None # Mapped past the new end, map the file again on the next read
+
+        self.index.build(self.storage)
+        for key, data in self.storage.items():
+            self.merkle.update(data.position, key, None, data)
+        logging.info(f'Replayed {self.log_records} records, {len(self.storage)} keys from {self.path} in {time.monotonic() - start:.2f}s')
+
+    # Replay fills the key map only, the ring map is built once at the end
+    def load(self, key: str, data: Data):
+        data.position = getShaRepr(key)
+        self.storage[key] = data
+
+    def unload(self, key: str):
+        self.storage.pop(key, None)
+
+    # Encode a record, also returns where its value starts and how long it is
+    def encode(self, key: str, value, version: int, active: bool) -> Tuple[bytearray, int, int]:
+        payload = encode_fields(bytearray(), [key])
+        value_start = len(payload) + STR_HEADER
+        encode_fields(payload, [value])
+        value_length = len(payload) - value_start
+        encode_fields(payload, [version, active])
+        return RECORD.pack(len(payload), zlib.crc32(payload)) + payload, RECORD.size + value_start, value_length
+
+    # Write a record and return the data reading its value from the log.
+    # It reaches the OS right away so the map can read it, fsync waits for the sync thread.
+    def append(self, key: str, value, version: int, active: bool) -> LogData:
+        record, value_start, value_length = self.encode(key, value, version, active)
+        offset = self.size
+        self.log.write(record)
+        self.log.flush()
+        self.size += len(record)
+        self.log_records += 1
+        self.dirty = True
+        crc = zlib.crc32(memoryview(record)[value_start:value_start + value_length])
+        return LogData(self.segment, offset + value_start, value_length, version, active, crc=crc)
+
+    # Every record published is appended first, log_lock keeps the log in the order of the changes
+    def write(self, key: str, data: Data):
+        with self.log_lock:
+            entry = self.append(key, data.text(), data.version, data.active)
+            entry.position = data.position
+            super().write(key, entry)
+
+    def drop(self, key: str, data: Data):
+        with self.log_lock:
+            self.append(key, '', data.version, None)
+            super().drop(key, data)
+
+    # Fsync thread, one fsync covers every write made since the last one
+    def sync(self):
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            try:
+                with self.log_lock:
+                    if self.closed or not self.dirty:
+                        continue
+                    self.dirty = False
+                    fd = self.log.fileno()
+                os.fsync(fd)
+
+                if self.size > self.compact_min_size and self.log_records > self.compact_ratio * len(self.storage):
+                    self.compact()
+            except Exception as e:
+                logging.error(f'Error syncing storage log {self.path}: {e}')
+
+    # Rewrite the log with the last record of every key and swap it in place. Writers wait on log_lock,
+    # readers go on. Values are copied from the old map without decoding them. Readers holding data of
+    # the old log keep reading it, its map stays valid after the file is replaced.
+    def compact(self):
+        with self.log_lock:
+            start = time.monotonic()
+            before = self.size
+            compacted = self.path + '.compact'
+            places: Dict[str, Tuple[int, int]] = {}
+            size = 0
+            with open(compacted, 'wb') as file:
+                for key, data in self.snapshot().items():
+                    record, value_start, value_length = self.encode(key, data.text(), data.version, data.active)
+                    file.write(record)
+                    places[key] = (size + value_start, value_length)
+                    size += len(record)
+                file.flush()
+                os.fsync(file.fileno())
+
+            self.log.close()
+            os.replace(compacted, self.path)
+            self.sync_dir()
+            self.log = open(self.path, 'ab')
+            old = self.segment
+            self.segment = Segment(self.path)
+            for key, (offset, length) in places.items():
+                data = self.storage[key]
+                self.storage[key] = LogData(self.segment, offset, length, data.version, data.active, data.position, data.digest())
+            self.index.build(self.storage)
+            old.close()
+
+            self.size = size
+            self.log_records = len(self.storage)
+            self.dirty = False
+            logging.info(f'Compacted {self.path} from {before} to {self.size} bytes in {time.monotonic() - start:.2f}s')
+
+    # Make the rename of the compacted log durable
+    def sync_dir(self):
+        fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self.log_lock:
+            self.closed = True
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.log.close()
+            self.segment.close()
 
-        return True
\ No newline at end of file
+# Storage engine chosen in the configuration, name tells apart the files of each node
+def create_storage(name: str, engine: str = STORAGE_ENGINE, path: str = STORAGE_PATH) -> Storage:
+    if engine == 'log':
+        return LogStorage(os.path.join(path, f'{name}.log'))
+    return RAMStorage()
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import threading
 import time
@@ -22,7 +23,8 @@ class Timer:
         
         return total_time // len(self.node_timers)
     
-    def update_time(self):
+    # Runs in the event loop, time_lock is only held for short updates
+    async def update_time(self):
         logging.info("Update time thread started")
         while not self.node.shutdown_event.is_set():
             try: 
@@ -31,4 +33,4 @@ class Timer:
                     self.node_timers[self.node.id] += 1
             except Exception as e:
                 logging.error(f'Error in update time thread: {e}')
-            time.sleep(1)
\ No newline at end of file
+            await asyncio.sleep(1)
\ No newline at end of file
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Coroutine, List
+
+from config import MAINTENANCE_WORKERS
+
+# Every node to node connection of the process lives in this event loop
+loop = asyncio.new_event_loop()
+loop_thread = threading.Thread(target=loop.run_forever, name='chord-event-loop', daemon=True)
+loop_thread.start()
+
+# Threads running the blocking steps of the periodic tasks, shared by all of them
+maintenance = ThreadPoolExecutor(MAINTENANCE_WORKERS, thread_name_prefix='chord-maintenance')
+WAKE_CHECK = 0.5 # Seconds between checks of the wake event of a periodic task
+
+# Schedule a coroutine in the event loop without waiting for it
+def spawn(coro: Coroutine) -> Future:
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+# Sync facade: run a coroutine in the event loop and wait for its result
+def run(coro: Coroutine) -> Any:
+    if threading.current_thread() is loop_thread:
+        coro.close()
+        raise RuntimeError('Blocking call made from the event loop')
+    return spawn(coro).result()
+
+# Run several coroutines at once, exceptions are returned in place of their results
+def run_all(coros: List[Coroutine]) -> List[Any]:
+    async def gather():
+        return await asyncio.gather(*coros, return_exceptions=True)
+    return run(gather())
+
+# Run several coroutines at once but only wait until count of them succeeded, or every one ended.
+# A result succeeds if accept says so, by default if it is True. The others go on in the event loop.
+# Results not known yet are None, exceptions are returned in place.
+def run_until(coros: List[Coroutine], count: int, accept: Callable[[Any], bool] = lambda result: result is True) -> List[Any]:
+    async def wait():
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        pending = set(tasks)
+        acks = 0
+        while pending and acks < count:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            acks += sum(1 for task in done if not task.exception() and accept(task.result()))
+        for task in pending:
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return [(task.exception() or task.result()) if task.done() else None for task in tasks]
+    return run(wait())
+
+# Run step every interval seconds until stop is set. The task waits in the event loop and only the
+# step takes a maintenance thread. Setting wake, if given, starts the next step right away.
+def every(interval: float, step: Callable[[], Any], stop: threading.Event, wake: threading.Event = None) -> Future:
+    async def repeat():
+        while not stop.is_set():
+            try:
+                await loop.run_in_executor(maintenance, step)
+            except Exception as e:
+                logging.error(f'Error in periodic task {step.__qualname__}: {e}')
+
+            if wake is None:
+                await asyncio.sleep(interval)
+                continue
+            waited = 0.0
+            while waited < interval and not wake.is_set():
+                await asyncio.sleep(WAKE_CHECK)
+                waited += WAKE_CHECK
+    return spawn(repeat())
+
+# Run step once in a maintenance thread, after delay seconds if given, without waiting for it.
+# The delay is kept by the event loop, so no thread is held meanwhile.
+def submit(step: Callable[[], Any], delay: float = 0) -> None:
+    if delay > 0:
+        loop.call_soon_threadsafe(loop.call_later, delay, maintenance.submit, step)
+    else:
+        maintenance.submit(step)
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Callable, Dict
+
+from config import SERVER_QUEUE_DEPTH, SERVER_WORKER_IDLE, SERVER_WORKERS
+
+# Time spent by the requests of one operation waiting for a free worker
+class QueueMetrics:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float):
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def to_dict(self) -> Dict[str, float]:
+        mean = self.total_wait / self.count if self.count else 0.0
+        return {'count': self.count, 'mean_wait': mean, 'max_wait': self.max_wait}
+
+# Threads running the blocking request handlers for the event loop. A thread is started when a request
+# finds no idle one, up to size, and ends after waiting idle_timeout seconds, so an idle node keeps none.
+class WorkerPool:
+    def __init__(self, size: int = SERVER_WORKERS, queue_depth: int = SERVER_QUEUE_DEPTH, idle_timeout: float = SERVER_WORKER_IDLE) -> None:
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.tasks = queue.SimpleQueue()
+        self.slots = asyncio.Semaphore(queue_depth)
+        self.metrics: Dict[int, QueueMetrics] = defaultdict(QueueMetrics)
+        self.metrics_lock = threading.Lock()
+
+        self.threads = 0
+        self.idle = 0
+        self.threads_lock = threading.Lock() # Only held to count threads, never while waiting
+        self.started = 0
+
+    # Waits in the event loop for a free queue slot, so a flooded node stops reading new requests.
+    # Returns a future with the result of the call.
+    async def submit(self, op: int, fn: Callable, *args) -> asyncio.Future:
+        await self.slots.acquire()
+
+        future = Future()
+        self.tasks.put((op, time.monotonic(), future, fn, args))
+        self._grow()
+
+        result = asyncio.wrap_future(future)
+        result.add_done_callback(lambda _: self.slots.release())
+        return result
+
+    # Start a thread if the queued requests outnumber the idle threads
+    def _grow(self):
+        with self.threads_lock:
+            if self.threads >= self.size or self.tasks.qsize() <= self.idle:
+                return
+            self.threads += 1
+            self.idle += 1
+            self.started += 1
+            name = f'chord-worker-{self.started}'
+        threading.Thread(target=self._work, name=name, daemon=True).start()
+
+    def _work(self):
+        while True:
+            try:
+                op, queued_at, future, fn, args = self.tasks.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self.threads_lock:
+                    if self.tasks.qsize() == 0:
+                        self.threads -= 1
+                        self.idle -= 1
+                        return
+                continue
+
+            with self.threads_lock:
+                self.idle -= 1
+            self._grow() # Requests queued while this thread still counted as idle
+            try:
+                self._run(op, queued_at, future, fn, args)
+            finally:
+                with self.threads_lock:
+                    self.idle += 1
+
+    def _run(self, op: int, queued_at: float, future: Future, fn: Callable, args):
+        wait = time.monotonic() - queued_at
+        with self.metrics_lock:
+            self.metrics[op].record(wait)
+
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            logging.error(f'Error in worker thread: {e}')
+            future.set_exception(e)
+
+    def queue_depth(self) -> int:
+        return self.tasks.qsize()
+
+    def thread_count(self) -> int:
+        return self.threads
+
+    def stats(self) -> Dict[int, Dict[str, float]]:
+        with self.metrics_lock:
+            return {op: metrics.to_dict() for op, metrics in self.metrics.items()}
@@ -7,4 +7,53 @@ PORT = 10000
 BROADCAST_LISTEN_PORT = 11000
 BROADCAST_REQUEST_PORT = 12000
 
-SEPARATOR = ';'
\ No newline at end of file
+SEPARATOR = ';'
+# Node to node connections
+CONNECTION_TIMEOUT = 3
+CONNECTION_IDLE_TIMEOUT = 30
+CONNECTION_POOL_SIZE = 2
+CHANNEL_MAX_IN_FLIGHT = 64
+MAX_FRAME_SIZE = 128 * 1024 * 1024 # Bytes of the largest message accepted, a longer one closes the connection
+
+# Chord request handling
+SERVER_WORKERS = 32 # Most threads serving requests at once, started on demand
+SERVER_WORKER_IDLE = 30 # Seconds a worker waits for a request before its thread ends
+SERVER_QUEUE_DEPTH = 256
+
+# Chord maintenance
+FIX_FINGERS_BATCH = 8
+MAINTENANCE_WORKERS = 4 # Threads shared by the blocking steps of the periodic tasks
+
+# Multi-key reads
+SCATTER_FANOUT = 8
+SCATTER_DEADLINE = 2
+
+# Key routing
+ROUTING_CACHE_SIZE = 1024
+KEY_HASH_CACHE_SIZE = 65536
+ONE_HOP_ROUTING = False
+MEMBERSHIP_TTL = 30
+
+# Storage
+STORAGE_ENGINE = 'ram' # 'ram' or 'log'
+STORAGE_PATH = 'data'
+STORAGE_FSYNC_INTERVAL = 0.1
+STORAGE_COMPACT_RATIO = 2
+STORAGE_COMPACT_MIN_SIZE = 4 * 1024 * 1024
+STORAGE_LOCK_STRIPES = 64
+STORAGE_CHUNK_SIZE = 256 # Keys per chunk of the copy on write index
+STORAGE_INDEX_FANOUT = 32 # Children per branch of the copy on write index
+TOMBSTONE_GRACE = 3600
+TOMBSTONE_GC_INTERVAL = 60
+REPLICATION_ACK = 'none' # 'none', 'one', 'quorum' or 'all' successors acknowledging a write, none never fails it
+REPLICATION_LOG_SIZE = 100000 # Last writes kept to send successors only what they missed
+REPLICATION_MODE = 'sync' # 'sync' or 'async', async writes return before they are replicated
+REPLICATION_QUEUE_SIZE = 10000 # Writes queued for each successor before writers wait
+REPLICATION_QUEUE_TIMEOUT = 1 # Seconds writers wait for room before the queue is dropped
+REPLICATION_BATCH = 256 # Queued writes sent in one message
+REPLICATION_RETRY = 1 # Seconds before a failed batch is retried
+HINT_LIMIT = 10000 # Keys hinted for a successor before it is caught up from the log instead
+HINT_TTL = 3600 # Seconds hints wait for a successor to come back
+READ_POLICY = 'primary' # 'primary', 'nearest', 'least_loaded' or 'quorum' replicas answering get_key
+REPLICA_SET_TTL = 10 # Seconds the replicas of a node are cached for reads
+MERKLE_DEPTH = 10 # 2 ** depth buckets of the ring in the anti-entropy trees
@@ -4,6 +4,7 @@ import logging
 import grpc
 
 from chord.node import ChordNode
+from persistency.scatter_gather import ScatterGather
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -46,6 +47,39 @@ def load(node: ChordNode, path, obj):
 
     return obj, None
 
+# Load several files at once, in the order of paths. With partial, files whose node could not answer
+# before the deadline are left out instead of failing the whole load, and their paths are returned
+# so the caller can report the result as incomplete.
+def load_many(node: ChordNode, paths, new_obj, partial=False):
+    logging.debug(f"Loading {len(paths)} files")
+
+    result = ScatterGather(node).get_many(paths)
+    if not result.complete and not partial:
+        logging.error(f"Error getting {len(result.missing)} files")
+        return None, [], grpc.StatusCode.UNAVAILABLE
+
+    missing = set(result.missing)
+    objs = []
+    for path in paths:
+        if path in missing:
+            continue
+
+        data_str = result.values.get(path, '')
+        if is_empty(data_str):
+            logging.error(f"Error getting file {path}")
+            return None, [], grpc.StatusCode.NOT_FOUND
+
+        try:
+            obj = new_obj()
+            obj.ParseFromString(base64.b64decode(data_str))
+        except Exception as e:
+            logging.error(f"Error decoding object: {e}")
+            return None, [], grpc.StatusCode.INTERNAL
+
+        objs.append(obj)
+
+    return objs, result.missing, None
+
 def delete(node: ChordNode, path):
     logging.debug(f"Deleting file: {path}")
 
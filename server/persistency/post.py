@@ -2,7 +2,7 @@ import os
 import grpc
 
 from chord.node import ChordNode
-from persistency.persistency import save, load, delete, file_exists
+from persistency.persistency import save, load, load_many, delete, file_exists
 from interfaces.grpc.models.models_pb2 import Post, UserPosts
 
 class PostPersitency:
@@ -69,20 +69,22 @@ class PostPersitency:
 
         return None
 
-    def load_posts_list(self, username):
+    # With partial, posts of nodes that could not answer are left out and their ids returned as missing
+    def load_posts_list(self, username, partial=False):
         path = os.path.join("User", username.lower(), "Posts")
         user_posts, err = load(self.node, path, UserPosts())
         list = []
 
         if err == grpc.StatusCode.NOT_FOUND:
-            return list, None
+            return list, [], None
 
         if err:
-            return None, grpc.StatusCode.INTERNAL("Failed to load user posts: {}".format(err))
-
-        for post_id in user_posts.posts_ids:
-            post, err = self.load_post(post_id)
-            if err:
-                return None, err
-            list.append(post)
-        return list, None
+            return None, [], grpc.StatusCode.INTERNAL
+
+        paths = [os.path.join("Post", post_id) for post_id in user_posts.posts_ids]
+        posts, missing, err = load_many(self.node, paths, Post, partial)
+        if err:
+            return None, [], err
+
+        list.extend(posts)
+        return list, [os.path.basename(path) for path in missing], None
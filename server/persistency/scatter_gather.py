@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Tuple
+
+from chord.node import ChordNode
+from chord.node_reference import ChordNodeReference
+from chord.transport import run
+from config import SCATTER_DEADLINE, SCATTER_FANOUT
+
+class GatherResult:
+    def __init__(self) -> None:
+        self.values: Dict[str, str] = {}
+        self.missing: List[str] = [] # Keys whose node failed or missed the deadline
+        self.refused: List[Tuple[ChordNodeReference, List[str]]] = [] # Batches sent to a node that no longer owns them
+        self.failed_nodes: List[str] = []
+
+    @property
+    def complete(self) -> bool:
+        return not self.missing
+
+# Fetches the batches of every responsible node at once, so a multi-key read costs the slowest node
+# instead of the sum of all of them. At most fanout batches are in flight and whatever arrives before
+# the deadline is returned.
+class ScatterGather:
+    def __init__(self, node: ChordNode, fanout: int = SCATTER_FANOUT, deadline: float = SCATTER_DEADLINE) -> None:
+        self.node = node
+        self.fanout = fanout
+        self.deadline = deadline
+
+    def get_many(self, keys: List[str]) -> GatherResult:
+        start = time.monotonic()
+        groups = self.node.group_keys(keys)
+        remaining = max(self.deadline - (time.monotonic() - start), 0)
+
+        result = run(self._gather([group for group in groups.values()], remaining))
+        for succ, keys in result.refused:
+            self.reroute(result, succ, keys)
+        if not result.complete:
+            logging.warning(f'Partial read: {len(result.missing)} keys missing from {result.failed_nodes}')
+        return result
+
+    async def _gather(self, groups, timeout: float) -> GatherResult:
+        semaphore = asyncio.Semaphore(self.fanout)
+
+        async def fetch(succ: ChordNodeReference, keys: List[str]):
+            async with semaphore:
+                return await succ.retrieve_many_async(keys, True)
+
+        tasks = [(asyncio.create_task(fetch(succ, keys)), succ, keys) for succ, keys in groups]
+        if tasks:
+            _, pending = await asyncio.wait([task for task, _, _ in tasks], timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+        result = GatherResult()
+        for task, succ, keys in tasks:
+            if task.done() and not task.cancelled() and task.exception() is None:
+                if task.result() is None:
+                    result.refused.append((succ, keys))
+                    continue
+                for key, data in task.result().items():
+                    result.values[key] = data.value
+            else:
+                result.missing.extend(keys)
+                result.failed_nodes.append(succ.ip)
+        return result
+
+    # The grouping was stale, so drop the cached route and read each key through the routed single key path
+    def reroute(self, result: GatherResult, succ: ChordNodeReference, keys: List[str]) -> None:
+        logging.info(f'{succ.ip} refused {len(keys)} keys, routing them one by one')
+        self.node.routes.invalidate(succ.id)
+        for key in keys:
+            try:
+                result.values[key] = self.node.get_key(key)
+            except ConnectionError:
+                result.missing.append(key)
+                if succ.ip not in result.failed_nodes:
+                    result.failed_nodes.append(succ.ip)
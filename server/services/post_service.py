@@ -54,7 +54,9 @@ class PostService(PostServiceServicer):
         user_id = request.user_id
         if not check_permission(self.user_persistency, user_id):
             context.abort(grpc.StatusCode.PERMISSION_DENIED, "Permission denied")
-        posts, err = self.post_persistency.load_posts_list(user_id)
+        posts, _, err = self.post_persistency.load_posts_list(user_id)
+        if err:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "Failed to load user posts")
 
         for post in posts:
             if post.original_post_id == request.original_post_id:
@@ -104,11 +106,16 @@ class PostService(PostServiceServicer):
         if not self.user_persistency.load_user(user_id):
             context.abort(grpc.StatusCode.NOT_FOUND, "User not found")
 
-        posts, err = self.post_persistency.load_posts_list(user_id)
+        posts, missing, err = self.post_persistency.load_posts_list(user_id, partial=True)
         
         if err:
             context.abort(grpc.StatusCode.INTERNAL, "Failed to load user posts")
 
+        # Posts whose node did not answer in time are left out, the client is told which ones
+        if missing:
+            logging.warning(f"Returning {len(posts)} posts of {user_id}, {len(missing)} missing")
+            context.set_trailing_metadata((("missing-posts", ",".join(missing)),))
+
         return GetUserPostsResponse(posts=posts)
 
 
@@ -0,0 +1,92 @@
+from typing import Dict, List
+
+import pytest
+
+from chord.protocol import decode_fields, encode_fields
+from chord.replicator import Replicator
+from chord.storage import Data, LogStorage
+from chord.utils import getShaRepr
+
+# Node a replicator belongs to, alone in its ring
+class FakeNode:
+    def __init__(self, ip: str) -> None:
+        self.ip = ip
+        self.id = getShaRepr(ip)
+
+# Fields as the peer gets them from the wire
+def wire(*fields) -> List:
+    return decode_fields(memoryview(encode_fields(bytearray(), list(fields))))
+
+# Peer answering the sync requests from another replicator in the same process
+class LocalPeer:
+    def __init__(self, replicator: Replicator) -> None:
+        self.replicator = replicator
+        self.ip = replicator.node.ip
+
+    def merkle_hashes(self, nodes: List[int]) -> List[int]:
+        return wire(self.replicator.merkle_hashes(*wire(nodes)))[0]
+
+    def merkle_keys(self, buckets: List[int], start: int, end: int) -> Dict[str, List]:
+        return wire(self.replicator.merkle_keys(*wire(buckets, start, end)))[0]
+
+    def retrieve_many(self, keys: List[str]) -> Dict[str, Data]:
+        values = wire(self.replicator.get_many(*wire(keys)))[0]
+        return {key: Data(value, version) for key, (value, version) in values.items()}
+
+    def resolve_data(self, dict: Dict[str, str], version: Dict[str, int], removed_dict: Dict[str, int]):
+        return wire(*self.replicator.resolve_data(*wire(dict, version, removed_dict))), True
+
+def log_replicator(path, ip: str) -> Replicator:
+    replicator = Replicator(FakeNode(ip), None)
+    replicator.storage = LogStorage(str(path / f'{ip}.log'))
+    return replicator
+
+def record(replicator: Replicator, key: str):
+    data = replicator.storage.get_record(key)
+    return data.value, data.version, data.active
+
+@pytest.fixture
+def replicators(tmp_path):
+    ours, theirs = log_replicator(tmp_path, '10.0.0.1'), log_replicator(tmp_path, '10.0.0.2')
+    yield ours, theirs
+    ours.storage.close()
+    theirs.storage.close()
+
+def test_sync_range_with_log_storage(replicators):
+    ours, theirs = replicators
+    ours.storage.set('only-ours', Data('a', 10))
+    ours.storage.set('newer-ours', Data('b', 20))
+    theirs.storage.set('newer-ours', Data('old', 15))
+    theirs.storage.set('only-theirs', Data('c', 30))
+    theirs.storage.set('removed', Data('d', 5))
+    theirs.storage.remove('removed', 40)
+    ours.storage.set('removed', Data('d', 5))
+
+    ours.sync_range(LocalPeer(theirs), 0, 0)
+
+    for replicator in (ours, theirs):
+        assert record(replicator, 'only-ours') == ('a', 10, True)
+        assert record(replicator, 'newer-ours') == ('b', 20, True)
+        assert record(replicator, 'only-theirs') == ('c', 30, True)
+        assert record(replicator, 'removed')[1:] == (40, False)
+    assert ours.storage.merkle.hashes([1]) == theirs.storage.merkle.hashes([1])
+
+def test_sync_range_breaks_version_ties_on_the_value(replicators):
+    ours, theirs = replicators
+    ours.storage.set('same-second', Data('A', 100))
+    theirs.storage.set('same-second', Data('B', 100))
+    assert ours.storage.merkle.hashes([1]) != theirs.storage.merkle.hashes([1])
+
+    ours.sync_range(LocalPeer(theirs), 0, 0)
+
+    assert record(ours, 'same-second') == record(theirs, 'same-second')
+    assert ours.storage.merkle.hashes([1]) == theirs.storage.merkle.hashes([1])
+
+    ours.storage.set('same-second', Data('B', 100))
+    theirs.storage.set('same-second', Data('A', 100))
+    theirs.sync_range(LocalPeer(ours), 0, 0)
+    assert record(ours, 'same-second') == record(theirs, 'same-second')
+
+def test_unknown_ack_level_is_rejected():
+    with pytest.raises(ValueError):
+        Replicator(FakeNode('10.0.0.3'), None, ack='majority')